@@ -4,8 +4,12 @@
 # Copyright (C) 2015 Stephen Nayfach
 # Freely distributed under the GNU General Public License (GPLv3)
 
-import sys, os, gzip, numpy as np, random, csv
+import sys, os, io, gzip, numpy as np, pandas as pd, random, csv, itertools
 from midas.utility import print_copyright
+from midas import snps_matrix
+
+BLOCK_SITES = 10000 # sites read at once by fetch_blocks
+MAX_GAP = 100 # rows between selected sites that are read rather than skipped
 
 class Sample:
 	""" Base class for sample """
@@ -39,56 +43,255 @@ class Species:
 		self.paths = {}
 		for type in ['freq', 'depth', 'info', 'summary']:
 			self.paths[type] = '%s/snps_%s.txt' % (self.dir, type)
+		self.paths['matrix'] = '%s/snps_matrix.bin' % self.dir
+		# freq and depth are read from snps_matrix.bin if merged with --matrix_format binary
+		self.matrix_types = ['freq', 'depth'] if os.path.exists(self.paths['freq']) or not os.path.exists(self.paths['matrix']) else ['matrix']
 
 	def init_files(self):
 		self.files = {}
-		for type in ['freq', 'depth', 'info', 'summary']:
-			file = open(self.paths[type])
-			if type in ['info', 'summary']:
-				self.files[type] = csv.DictReader(file, delimiter='\t')
+		self.matrix_blocks = None # block index of snps_matrix.bin, read on first seek
+		for type in self.matrix_types + ['info', 'summary']:
+			if type == 'matrix':
+				self.matrix = snps_matrix.MatrixReader(self.paths[type])
+				self.files[type] = MatrixRows(self.matrix)
 			else:
-				self.files[type] = csv.reader(file, delimiter='\t')
+				self.files[type] = open(self.paths[type])
+		self.info_fields = next(self.files['info']).rstrip('\n').split('\t')
+		self.files['summary'] = csv.DictReader(self.files['summary'], delimiter='\t')
 
 	def init_samples(self):
 		self.sample_ids = None
-		for file in ['freq', 'depth']:
-			self.sample_ids = next(self.files[file])[1:]
+		if 'matrix' in self.files:
+			self.sample_ids = self.matrix.sample_ids
+		else:
+			for file in ['freq', 'depth']:
+				self.sample_ids = next(self.files[file]).rstrip('\n').split('\t')[1:]
+		self.columns = np.arange(len(self.sample_ids))
+
+	def select_samples(self, samples):
+		""" Only read the columns of <samples> from freq and depth matrices, in the order of <samples> """
+		self.columns = np.array([sample.index for sample in samples.values()], dtype=np.int64)
+		if 'matrix' in self.files:
+			self.files['matrix'].select(self.columns)
+
+	def read_rows(self, count):
+		""" Read next <count> rows of tables, fewer at end of tables
+			Returns (dict of info columns, freqs, depths) with freqs and depths for selected sample columns """
+		info = read_table(''.join(itertools.islice(self.files['info'], count)), range(len(self.info_fields)), str)
+		info = dict(zip(self.info_fields, info.T))
+		nrows = len(info['site_id'])
+		if 'matrix' in self.files:
+			site_ids, freqs, depths = self.files['matrix'].read(nrows)
+			values, inverse = np.unique(freqs, return_inverse=True) # same precision as snps_freq.txt
+			freqs = np.array(['%.3g' % value for value in values], dtype=float)[inverse].reshape(freqs.shape)
+		else:
+			# only selected columns are converted; usecols are parsed in file order
+			columns, order = np.unique(self.columns, return_inverse=True)
+			matrices = {}
+			for type, dtype in [('freq', float), ('depth', np.int64)]:
+				text = ''.join(itertools.islice(self.files[type], nrows))
+				matrices[type] = read_table(text, 1 + columns, dtype)[:, order]
+			freqs, depths = matrices['freq'], matrices['depth']
+		return info, freqs, depths
+
+	def skip_rows(self, count):
+		""" Skip next <count> rows of tables """
+		for type in self.matrix_types + ['info']:
+			if type == 'matrix':
+				self.files[type].skip(count)
+				continue
+			for row in itertools.islice(self.files[type], count):
+				pass
+
+	def seek(self, row, index):
+		""" Position tables at <row> (0-based, not counting headers) using site index """
+		for type in self.matrix_types + ['info']:
+			if type == 'matrix':
+				if self.matrix_blocks is None:
+					self.matrix_blocks = snps_matrix.read_index(self.paths['matrix'])
+				site_id = index.site_ids[row]
+				block = max(0, np.searchsorted(self.matrix_blocks[:, 1], site_id, side='right') - 1)
+				self.files[type].seek(self.matrix_blocks[block, 0], site_id)
+				continue
+			offset, skip = index.row_offset(type, row)
+			self.files[type].seek(offset)
+			for i in range(skip):
+				self.files[type].readline()
+
+def read_table(text, columns, dtype):
+	""" Parse <columns> of tab-delimited rows of <text> into 2D array of <dtype> """
+	if not text:
+		return np.zeros((0, len(columns)), dtype=object if dtype is str else dtype)
+	if dtype is str:
+		return pd.read_csv(io.StringIO(text), sep='\t', header=None, usecols=columns, dtype=str, na_filter=False).values
+	return pd.read_csv(io.StringIO(text), sep='\t', header=None, usecols=columns, dtype=dtype, float_precision='round_trip').values
+
+class MatrixRows:
+	""" Read consecutive rows of snps_matrix.bin, one decompressed block at a time """
+	def __init__(self, matrix):
+		self.matrix = matrix
+		self.block = None # (site_ids, freqs, depths) of current block
+		self.offset = None # byte offset of current block
+		self.position = 0 # next row of current block
+
+	def next_block(self, offset=None):
+		""" Decompress next block or block at <offset>; returns False at end of file """
+		self.offset = self.matrix.file.tell() if offset is None else offset
+		self.block = self.matrix.read_block(offset)
+		self.position = 0
+		return self.block is not None
+
+	def seek(self, offset, first_site):
+		""" Position at site <first_site> of block at <offset> """
+		self.next_block(offset)
+		if self.block is not None:
+			self.position = np.searchsorted(self.block[0], first_site)
+
+	def select(self, columns):
+		""" Only decompress sample <columns>; the current block is read again """
+		self.matrix.columns = columns
+		if self.block is not None:
+			position = self.position
+			self.next_block(self.offset)
+			self.position = position
+
+	def read(self, count):
+		""" Return (site_ids, freqs, depths) of next <count> rows, fewer at end of file """
+		pieces = []
+		while count > 0 and (self.block is not None and self.position < len(self.block[0]) or self.next_block()):
+			end = min(len(self.block[0]), self.position + count)
+			pieces.append([values[self.position:end] for values in self.block])
+			count -= end - self.position
+			self.position = end
+		if not pieces:
+			return np.zeros(0, dtype=np.int64), np.zeros((0, len(self.matrix.columns))), np.zeros((0, len(self.matrix.columns)), dtype=np.int64)
+		return tuple(np.concatenate(values) for values in zip(*pieces))
+
+	def skip(self, count):
+		self.read(count)
+
+class GenomicSites:
+	""" Block of consecutive genomic sites with aligned arrays over samples
+		info: dict of snps_info.txt columns; freq, depth: sites x samples arrays, in the order of <samples>
+		Methods are vectorized equivalents of those of GenomicSite and set arrays over the block:
+		sample_keep (sites x samples), prevalence, pooled_maf, keep (sites) """
+	def __init__(self, info, freq, depth, samples):
+		self.info = info
+		self.id = info['site_id']
+		self.ref_allele = info['ref_allele']
+		self.minor_allele = info['minor_allele']
+		self.major_allele = info['major_allele']
+		self.gene_id = info['gene_id']
+		self.locus_type = info['locus_type']
+		self.site_type = info['site_type']
+		self.freq = freq
+		self.depth = depth
+		self.samples = samples
+		self.sample_list = list(samples.values())
+		self.mean_depth = np.array([sample.mean_depth for sample in self.sample_list])
+
+	def __len__(self):
+		return len(self.id)
+
+	def subset(self, rows):
+		""" Return block of sites at <rows> (indexes or boolean mask), keeping computed arrays """
+		info = dict([(field, values[rows]) for field, values in self.info.items()])
+		block = GenomicSites(info, self.freq[rows], self.depth[rows], self.samples)
+		for name in ['sample_keep', 'count_samples', 'prevalence', 'pooled_maf', 'keep']:
+			if hasattr(self, name):
+				setattr(block, name, getattr(self, name)[rows])
+		return block
+
+	def site(self, index):
+		""" Return GenomicSite at <index>; sets sample.freq and sample.depth """
+		return GenomicSite(self, index)
+
+	def flag_samples(self, site_depth, site_ratio, allele_support):
+		""" Filter samples at each site based on coverage; sets sample_keep """
+		with np.errstate(divide='ignore', invalid='ignore'):
+			self.sample_keep = ((self.depth >= site_depth)
+				& ~(self.depth / self.mean_depth > site_ratio)
+				& ~(np.maximum(self.freq, 1 - self.freq) < allele_support))
+
+	def filter(self, site_prev=None, site_maf=None, locus_type=None, site_type=None):
+		""" Determine which sites pass quality control; sets keep """
+		self.keep = np.isin(self.ref_allele, ['A','T','C','G'])
+		if site_prev:
+			self.keep &= ~(self.prevalence < max(1e-6, site_prev))
+		if site_maf:
+			self.keep &= ~(self.pooled_maf < site_maf)
+		if locus_type:
+			self.keep &= self.locus_type == locus_type
+		if site_type:
+			self.keep &= self.site_type == site_type
+
+	def summary_stats(self, weight):
+		""" Compute summary stats for sites across samples """
+		self.count_samples = self.sample_keep.sum(axis=1)
+		self.prevalence = self.count_samples / float(len(self.sample_list))
+		self.pooled_maf = self.compute_pooled_maf(weight)
+
+	def compute_pooled_maf(self, weight=False):
+		""" Compute average frequency of minor allele at each site with optional weighting of samples """
+		with np.errstate(divide='ignore', invalid='ignore'):
+			if weight:
+				depth = np.where(self.sample_keep, self.depth, 0).sum(axis=1)
+				maf = np.where(self.sample_keep, self.depth * self.freq, 0).sum(axis=1) / depth
+			else:
+				maf = np.where(self.sample_keep, self.freq, 0).sum(axis=1) / self.count_samples
+		return np.where(self.count_samples == 0, 0.0, maf)
+
+	def resample_reads(self, rand_reads, replace_reads, rows=None, rng=None):
+		""" Resample <rand_reads> reads per sample at each site, or at sites <rows>, from the reads of each sample
+			Counts of minor alleles are drawn for all samples at once: binomial with replacement, hypergeometric without
+			rng: numpy Generator; seeded from the system if None """
+		rng = rng if rng is not None else np.random.default_rng()
+		rows = np.arange(len(self)) if rows is None else rows
+		freq, depth = self.freq[rows], self.depth[rows]
+		count_minor = np.rint(freq * depth).astype(np.int64)
+		resample = (freq > 0) & (freq < 1)
+		if replace_reads:
+			draws = rng.binomial(rand_reads, np.where(resample, count_minor / np.maximum(depth, 1).astype(float), 0))
+		else:
+			# samples with fewer than rand_reads reads cannot be resampled; they fail --site_depth anyway
+			resample &= depth >= rand_reads
+			good = np.where(resample, count_minor, 0)
+			draws = rng.hypergeometric(good, np.where(resample, depth - good, rand_reads), rand_reads)
+		self.freq[rows] = np.where(resample, draws / float(rand_reads), freq)
+		self.depth[rows] = rand_reads
 
+	def call_consensus(self):
+		""" Call consensus allele at each position """
+		self.freq = np.round(self.freq)
+
+	def fetch_consensus(self):
+		""" Return sites x samples array of consensus alleles; '-' where sample was filtered or not covered """
+		alleles = np.where(self.freq >= 0.5, self.minor_allele[:, None], self.major_allele[:, None])
+		return np.where(self.sample_keep & (self.depth > 0), alleles, '-')
 
 class GenomicSite:
-	""" Base class for genomic sites """
-	def __init__(self, species, samples):
-		try:
-			# fetch site info
-			self.info = next(species.files['info'])
-			self.id = self.info['site_id']
-			self.ref_allele = self.info['ref_allele']
-			self.minor_allele = self.info['minor_allele']
-			self.major_allele = self.info['major_allele']
-			self.gene_id = self.info['gene_id']
-			self.locus_type = self.info['locus_type']
-			self.site_type = self.info['site_type']
-						
-			# copy samples
-			self.samples = samples
-			
-			# fetch site data from freq and depth matrixes
-			#	self.samples[sample.id].freq
-			#	self.samples[sample.id].depth
-			self.fetch_row(species)
+	""" Base class for genomic sites; a view of one site of a block of GenomicSites """
+	def __init__(self, block, index):
+		# fetch site info
+		self.info = dict([(field, values[index]) for field, values in block.info.items()])
+		self.id = self.info['site_id']
+		self.ref_allele = self.info['ref_allele']
+		self.minor_allele = self.info['minor_allele']
+		self.major_allele = self.info['major_allele']
+		self.gene_id = self.info['gene_id']
+		self.locus_type = self.info['locus_type']
+		self.site_type = self.info['site_type']
+
+		# copy samples
+		self.samples = block.samples
+
+		# fetch site data from freq and depth matrixes
+		#	self.samples[sample.id].freq
+		#	self.samples[sample.id].depth
+		for column, sample in enumerate(block.sample_list):
+			sample.freq = float(block.freq[index, column])
+			sample.depth = int(block.depth[index, column])
 
-		except StopIteration:
-			self.id = None
-		
-	def fetch_row(self, species):
-		""" Fetch next row from freq and depth matrices
-		    Store in sample objects: sample.freq, sample.depth """
-		freqs = next(species.files['freq'])[1:]
-		depths = next(species.files['depth'])[1:]
-		for sample in self.samples.values():
-			self.samples[sample.id].freq = float(freqs[sample.index])
-			self.samples[sample.id].depth = int(depths[sample.index])
-				
 	def flag_samples(self, site_depth, site_ratio, allele_support):
 		""" Filter samples at site based on coverage
 			Sets flag: sample.keep = [True/False] 
@@ -150,17 +353,17 @@ class GenomicSite:
 		else:
 			return np.mean([s.freq for s in self.samples.values() if s.keep])
 
-	def resample_reads(self, rand_reads, replace_reads):
+	def resample_reads(self, rand_reads, replace_reads, rng=None):
 		""" resample random number of reads per sample """
-		index = 0
+		rng = rng if rng is not None else np.random.default_rng()
 		for sample in self.samples.values():
-			sample.depth = rand_reads
 			if sample.freq > 0 and sample.freq < 1:
 				count_minor = int(round(sample.freq * sample.depth))
-				count_major = sample.depth - count_minor
-				alleles = np.random.choice([1]*count_minor+[0]*count_major, rand_reads, replace=replace_reads)
-				sample.freq = np.mean(alleles)
-			index += 1
+				if replace_reads:
+					sample.freq = rng.binomial(rand_reads, count_minor / float(sample.depth)) / float(rand_reads)
+				elif sample.depth >= rand_reads:
+					sample.freq = rng.hypergeometric(count_minor, sample.depth - count_minor, rand_reads) / float(rand_reads)
+			sample.depth = rand_reads
 			
 	def call_consensus(self):
 		""" call consensus allele at each position """
@@ -178,7 +381,7 @@ class GenomicSite:
 			return self.major_allele
 			
 def fetch_samples(species, mean_depth=0, fract_cov=0, max_samples=float('inf'),
-                  keep_samples=None, exclude_samples=None, rand_samples=None):
+                  keep_samples=None, exclude_samples=None, rand_samples=None, rng=None):
 	""" Select samples from input
 		mean_depth: filter samples based on average genome/gene depth
 		fract_cov: filter samples based on the number of genomic sites covered by >=1 read
@@ -186,6 +389,7 @@ def fetch_samples(species, mean_depth=0, fract_cov=0, max_samples=float('inf'),
 		keep_samples: only keep samples in this list
 		exclude_samples: exclude any sample in this list
 		rand_samples: select random subset of samples
+		rng: numpy Generator used to select random samples
 	"""
 	samples = {}
 	# select samples that pass filters
@@ -211,20 +415,91 @@ def fetch_samples(species, mean_depth=0, fract_cov=0, max_samples=float('inf'),
 		if rand_samples > len(samples):
 			error = "\nError: --rand_samples cannot exceed the number of samples\n"
 			sys.exit(error)
-		ids = np.random.choice(samples.keys(), rand_samples, replace=False)
-		for id in samples.keys():
+		ids = (rng if rng is not None else np.random).choice(list(samples.keys()), rand_samples, replace=False)
+		for id in list(samples.keys()):
 			if id not in ids:
 				del samples[id]
 	return samples
 
-def fetch_sites(species, samples):
-	""" yield genomic sites from species across samples """
-	index = 0
-	while True:
-		site = GenomicSite(species, samples)
-		if not site.id:
-			break
-		else:
-			index += 1
-			yield site
+def fetch_sites(species, samples, site_ids=None, regions=None):
+	""" yield genomic sites from species across samples
+		site_ids: only yield sites in this list
+		regions: only yield sites in this list of (ref_id, start, end); start and end may be None """
+	for block in fetch_blocks(species, samples, site_ids, regions):
+		for index in range(len(block)):
+			yield block.site(index)
+
+def fetch_blocks(species, samples, site_ids=None, regions=None, block_size=BLOCK_SITES):
+	""" yield blocks of up to <block_size> genomic sites from species across samples, as GenomicSites
+		site_ids: only yield sites in this list
+		regions: only yield sites in this list of (ref_id, start, end); start and end may be None
+		Sites are yielded in the order of the tables. With a site index (snps_index.npz from merge_midas.py),
+		only the blocks of rows holding selected sites are read; otherwise all sites are scanned """
+	species.select_samples(samples)
+	if site_ids is None and regions is None:
+		while True:
+			info, freqs, depths = species.read_rows(block_size)
+			if len(freqs) == 0:
+				break
+			yield GenomicSites(info, freqs, depths, samples)
+		return
+	index = snps_matrix.read_site_index(species.dir)
+	if index is None:
+		site_ids = set(site_ids) if site_ids is not None else None
+		for block in fetch_blocks(species, samples, block_size=block_size):
+			selected = in_selection(block, site_ids, regions)
+			if selected.any():
+				yield block.subset(selected)
+		return
+	rows = []
+	if site_ids is not None:
+		rows.append(index.site_rows([int(site_id) for site_id in site_ids if str(site_id).isdigit()]))
+	for ref_id, start, end in regions or []:
+		rows.append(index.region_rows(ref_id, start, end))
+	rows = np.unique(np.concatenate(rows))
+	pieces, count = [], 0 # selected rows read for next block
+	position = None # next row to be read from tables
+	for first, last in zip(*row_spans(rows)):
+		if position is None or first - position > snps_matrix.INDEX_ROWS:
+			species.seek(first, index)
+			position = first
+		species.skip_rows(first - position)
+		position = first
+		while position < last:
+			info, freqs, depths = species.read_rows(min(last - position, block_size))
+			selected = rows[np.searchsorted(rows, position):np.searchsorted(rows, position + len(freqs))] - position
+			pieces.append((dict([(field, values[selected]) for field, values in info.items()]), freqs[selected], depths[selected]))
+			count += len(selected)
+			position += len(freqs)
+			if count >= block_size:
+				yield join_rows(pieces, samples)
+				pieces, count = [], 0
+	if pieces:
+		yield join_rows(pieces, samples)
+
+def row_spans(rows):
+	""" Return (first rows, ends) of spans of sorted <rows> with gaps of at most MAX_GAP rows """
+	breaks = np.flatnonzero(np.diff(rows) > MAX_GAP + 1) + 1
+	firsts = rows[np.r_[0, breaks]] if len(rows) else rows
+	ends = rows[np.r_[breaks - 1, len(rows) - 1]] + 1 if len(rows) else rows
+	return firsts, ends
+
+def join_rows(pieces, samples):
+	""" Return GenomicSites from list of (info, freqs, depths) """
+	info = dict([(field, np.concatenate([piece[0][field] for piece in pieces])) for field in pieces[0][0]])
+	freqs = np.concatenate([piece[1] for piece in pieces])
+	depths = np.concatenate([piece[2] for piece in pieces])
+	return GenomicSites(info, freqs, depths, samples)
+
+def in_selection(block, site_ids, regions):
+	""" Return mask of sites of block in list of site_ids or regions """
+	selected = np.zeros(len(block), dtype=bool)
+	if site_ids is not None:
+		selected |= np.isin(block.id, list(site_ids))
+	for ref_id, start, end in regions or []:
+		ref_pos = block.info['ref_pos'].astype(np.int64)
+		selected |= ((block.info['ref_id'] == ref_id)
+			& (ref_pos >= start if start is not None else True)
+			& (ref_pos <= end if end is not None else True))
+	return selected
 
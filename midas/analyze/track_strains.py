@@ -4,10 +4,17 @@
 # Copyright (C) 2015 Stephen Nayfach
 # Freely distributed under the GNU General Public License (GPLv3)
 
-import sys, os, itertools
+import sys, os, numpy as np
 from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
 from midas import utility
 from midas.analyze import parse_snps
+from midas.merge.merge import format_rows
+
+BLOCK_SAMPLES = 256 # rows of sample pairs computed at once
+BLOCK_CELLS = 2**25 # samples x markers unpacked from the bit matrix at once, shared by all threads
+MARKER_BLOCK = 4096 # markers called before packing them into bits; a multiple of 8
+POPCOUNT = np.array([bin(byte).count('1') for byte in range(256)], dtype=np.int64)
 
 def id_markers(args):
 	""" Pipeline for identifying marker alleles """
@@ -73,14 +80,15 @@ def track_markers(args):
 
 	# determine marker alleles present in each sample
 	print("Determining marker alleles present in each sample")
-	call_markers(species, samples, args)
+	markers = call_markers(species, samples, args)
 
 	# quantify marker allele sharing between samples
 	print("Quantifying sharing of marker alleles between samples")
-	allele_sharing(samples, outfile)
+	allele_sharing(samples, markers, outfile, args['threads'])
 
 def call_markers(species, samples, args):
-	""" determine if marker present in each sample """
+	""" determine if marker present in each sample
+		returns packed bit matrix of samples x markers; bit is set if marker allele found in sample """
 	
 	# open marker list
 	markers = utility.parse_file(species.paths['markers'])
@@ -88,9 +96,11 @@ def call_markers(species, samples, args):
 	if marker is None:
 		sys.exit("\nError: no marker alleles found in file: %s\n" % species.paths['markers'])
 	
-	# init markers per sample
-	for sample in samples.values():
-		sample.markers = set([])
+	# one column of samples per marker site found; blocks of columns are packed as they fill
+	columns = dict([(sample_id, index) for index, sample_id in enumerate(samples)])
+	block = np.zeros((len(columns), MARKER_BLOCK), dtype=bool)
+	packed = [] # samples x MARKER_BLOCK/8 bytes per full block
+	nfound = 0
 
 	# loop over sites
 	sites = parse_snps.fetch_sites(species, samples)
@@ -104,6 +114,12 @@ def call_markers(species, samples, args):
 			continue
 			
 		# determine if marker present in each sample
+		if nfound == MARKER_BLOCK:
+			packed.append(np.packbits(block, axis=1))
+			block[:] = False
+			nfound = 0
+		present = block[:, nfound]
+		nfound += 1
 		for sample in site.samples.values():
 		
 			# skip samples without marker
@@ -120,12 +136,15 @@ def call_markers(species, samples, args):
 			sample.marker_count = round(sample.marker_freq * sample.depth)
 			if (sample.marker_freq >= args['min_freq']
 					and sample.marker_count >= args['min_reads']):
-				sample.markers.add(site.id)
+				present[columns[sample.id]] = True
 				
 		# fetch next marker allele
 		marker = fetch_marker(markers)
 		if marker is None: break
 
+	packed.append(np.packbits(block[:, :nfound], axis=1))
+	return np.hstack(packed)
+
 def fetch_marker(markers):
 	""" Fetch next marker allele from file """
 	try:
@@ -134,18 +153,42 @@ def fetch_marker(markers):
 	except StopIteration:
 		return None
 
-def allele_sharing(samples, outfile):
-	""" Compute sharing between sample pairs """
-	for index, pair in enumerate(itertools.combinations(samples, r=2)):
-		if not index % 500: print("%s sample pairs processed" % index)
-		sample1, sample2 = pair
-		alleles1 = samples[sample1].markers
-		alleles2 = samples[sample2].markers
-		count1 = len(alleles1)
-		count2 = len(alleles2)
-		count_both = len(set(alleles1 & alleles2))
-		count_either = len(set(alleles1 | alleles2))
-		record = [sample1, sample2, count1, count2, count_both, count_either]
-		outfile.write('\t'.join([str(_) for _ in record])+'\n')
-
-
+def unpack_markers(markers, rows, start, stop):
+	""" Unpack bytes <start>:<stop> of <rows> of packed marker matrix as float matrix for counting with products """
+	bits = np.unpackbits(markers[rows, start:stop], axis=1)
+	return bits.astype(np.float32 if markers.shape[1] * 8 < 2**24 else np.float64) # exact integer sums
+
+def count_shared(markers, start, stop, threads=1):
+	""" Count markers shared by samples <start>:<stop> and each sample from <start> on
+		Each of <threads> concurrent calls unpacks at most BLOCK_CELLS/threads cells at once
+		Returns (stop-start) x (nsamples-start) matrix of counts """
+	nbytes = max(1, BLOCK_CELLS // (8 * (markers.shape[0] - start) * threads))
+	counts = np.zeros((stop - start, markers.shape[0] - start))
+	for byte in range(0, markers.shape[1], nbytes):
+		block = unpack_markers(markers, slice(start, None), byte, byte + nbytes)
+		counts += np.dot(block[:stop - start], block.T)
+	return counts.astype(np.int64)
+
+def allele_sharing(samples, markers, outfile, threads=1):
+	""" Compute sharing between sample pairs
+		markers: packed bit matrix of samples x markers from call_markers
+		Rows of pairs are computed for blocks of samples in <threads> threads and written in order """
+	sample_ids = np.array(list(samples), dtype=object)
+	nsamples = len(sample_ids)
+	totals = POPCOUNT[markers].sum(axis=1)
+	fmt = '%s\t%s\t%s\t%s\t%s\t%s\n'
+	blocks = [(start, min(start + BLOCK_SAMPLES, nsamples)) for start in range(0, nsamples, BLOCK_SAMPLES)]
+	index = 0
+	with ThreadPoolExecutor(max_workers=threads) as executor:
+		for window in range(0, len(blocks), threads):
+			counts = executor.map(lambda block: count_shared(markers, block[0], block[1], threads), blocks[window:window+threads])
+			for (start, stop), shared in zip(blocks[window:window+threads], counts):
+				print("%s sample pairs processed" % index)
+				# pairs (i, j) with start <= i < stop and j > i, in the order of itertools.combinations
+				rows, columns = np.nonzero(np.arange(start, nsamples) > np.arange(start, stop)[:,None])
+				count_both = shared[rows, columns]
+				sample1, sample2 = rows + start, columns + start
+				count_either = totals[sample1] + totals[sample2] - count_both
+				outfile.write(format_rows([sample_ids[sample1], sample_ids[sample2],
+					totals[sample1], totals[sample2], count_both, count_either], fmt))
+				index += len(rows)
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+
+# MIDAS: Metagenomic Intra-species Diversity Analysis System
+# Copyright (C) 2015 Stephen Nayfach
+# Freely distributed under the GNU General Public License (GPLv3)
+
+import os, numpy as np
+from midas import utility
+
+# Per-position annotation arrays for a representative genome
+# Scaffolds are concatenated; position p (1-based) of scaffold s is at index offsets[s] + p - 1
+#   gene_index:  index of gene in gene_ids covering site, -1 for intergenic sites
+#   degeneracy:  1-4 for sites in coding genes (1D-4D), 0 if unknown or not coding
+#   amino_acids: ASCII codes of amino acids encoded by alleles A, C, G, T (+ strand), 0 if unknown
+# Where genes overlap, a site gets the gene with the lowest start, then the highest end (see GeneIndex)
+
+BASES = np.full(256, 4, dtype=np.uint8) # A, C, G, T -> 0-3; other characters -> 4
+for index, base in enumerate(b'ACGT'): BASES[base] = index
+CODONS = np.frombuffer(''.join(utility.translate(a+b+c) for a in 'ACGT' for b in 'ACGT' for c in 'ACGT').encode(), dtype=np.uint8)
+
+def read_features(inpath):
+	""" Read genes from features file; genes without a gene_type are coding genes """
+	genes = []
+	for gene in utility.parse_file(inpath):
+		gene['start'] = int(gene['start'])
+		gene['end'] = int(gene['end'])
+		gene['gene_type'] = gene.get('gene_type', 'CDS')
+		genes.append(gene)
+	return genes
+
+class GeneIndex:
+	""" Interval index over genes; finds the gene covering any set of sites in any order
+		Genes on each scaffold are sorted by start (asc), end (desc). With a running maximum of
+		their ends, the first gene in that order covering a site is found by two binary searches """
+	def __init__(self, arrays):
+		self.arrays = arrays # gene_id, scaffold_id, start, end, strand, gene_type; sorted by scaffold, start, -end
+		self.scaffolds = {}
+		scaffold_ids = arrays['scaffold_id']
+		bounds = np.flatnonzero(np.r_[True, scaffold_ids[1:] != scaffold_ids[:-1], True]) if len(scaffold_ids) else [0]
+		for first, last in zip(bounds[:-1], bounds[1:]):
+			self.scaffolds[scaffold_ids[first]] = (first, arrays['start'][first:last], np.maximum.accumulate(arrays['end'][first:last]))
+
+	@classmethod
+	def from_genes(cls, genes):
+		""" Build index from list of gene records """
+		order = sorted(range(len(genes)), key=lambda i: (genes[i]['scaffold_id'], genes[i]['start'], -genes[i]['end']))
+		arrays = {}
+		for field, dtype in [('gene_id', str), ('scaffold_id', str), ('start', np.int64), ('end', np.int64), ('strand', str), ('gene_type', str)]:
+			arrays[field] = np.array([genes[i][field] for i in order], dtype=dtype)
+		return cls(arrays)
+
+	def __len__(self):
+		return len(self.arrays['gene_id'])
+
+	def gene(self, index):
+		""" Return gene record at <index> """
+		return dict([(field, values[index].item()) for field, values in self.arrays.items()])
+
+	def query(self, ref_id, positions):
+		""" Return index of gene covering each position on scaffold <ref_id>, -1 if intergenic """
+		positions = np.asarray(positions, dtype=np.int64)
+		if ref_id not in self.scaffolds:
+			return np.full(len(positions), -1, dtype=np.int64)
+		first, starts, max_ends = self.scaffolds[ref_id]
+		candidates = np.searchsorted(starts, positions, side='right') # genes starting at or before site
+		covering = np.searchsorted(max_ends, positions, side='left') # first gene ending at or after site
+		return np.where(covering < candidates, first + covering, -1)
+
+	def save(self, path):
+		np.savez(path, **self.arrays)
+
+def read_gene_index(features_path):
+	""" Return GeneIndex for features file, using cached index next to it when up to date """
+	cache_path = '%s.index.npz' % features_path
+	if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(features_path):
+		arrays = np.load(cache_path)
+		return GeneIndex(dict([(field, arrays[field]) for field in arrays.files]))
+	index = GeneIndex.from_genes(read_features(features_path))
+	try:
+		index.save(cache_path)
+	except (IOError, OSError): # e.g. read-only database
+		pass
+	return index
+
+def read_fasta(inpath):
+	""" Read sequences from fasta file as uppercase bytes """
+	import Bio.SeqIO
+	infile = utility.iopen(inpath)
+	seqs = dict([(r.id, str(r.seq).upper().encode()) for r in Bio.SeqIO.parse(infile, 'fasta')])
+	infile.close()
+	return seqs
+
+def codon_changes(seq):
+	""" Return (degeneracy, amino acids) for each position of coding gene (oriented start to stop)
+		amino_acids has a column for each base substituted at that position, in gene orientation """
+	bases = BASES[np.frombuffer(seq, dtype=np.uint8)].reshape(-1, 3).astype(np.int64)
+	valid = np.repeat((bases < 4).all(axis=1), 3)
+	codon = np.repeat(16 * bases[:, 0] + 4 * bases[:, 1] + bases[:, 2], 3)
+	weight = np.tile([16, 4, 1], len(bases))
+	old_base = np.where(valid, bases.ravel(), 0)
+	new_codons = (codon - weight * old_base)[:, None] + weight[:, None] * np.arange(4)
+	amino_acids = CODONS[np.where(valid[:, None], new_codons, 0)]
+	# AA's identical: degeneracy = 4 - 1 + 1 = 4
+	# AA's all different, degeneracy = 4 - 4 + 1 = 1
+	sorted_aas = np.sort(amino_acids, axis=1)
+	unique_aas = 1 + (np.diff(sorted_aas, axis=1) != 0).sum(axis=1)
+	degeneracy = np.where(valid, 4 - unique_aas + 1, 0).astype(np.uint8)
+	amino_acids[~valid] = 0
+	return degeneracy, amino_acids
+
+def build_site_annotations(genome, genes):
+	""" Build per-position annotation arrays from genome {scaffold_id: seq} and GeneIndex of its genes
+		Genes on scaffolds missing from the genome are ignored """
+	scaffold_ids = sorted(genome)
+	offsets = np.cumsum([0] + [len(genome[scaffold_id]) for scaffold_id in scaffold_ids])
+	scaffold_offsets = dict(zip(scaffold_ids, offsets[:-1]))
+	gene_index = np.full(offsets[-1], -1, dtype=np.int32)
+	degeneracy = np.zeros(offsets[-1], dtype=np.uint8)
+	amino_acids = np.zeros((offsets[-1], 4), dtype=np.uint8)
+	locus_types = sorted(set(['IGR'] + list(genes.arrays['gene_type'])))
+	for scaffold_id in scaffold_ids:
+		offset = scaffold_offsets[scaffold_id]
+		gene_index[offset:offset+len(genome[scaffold_id])] = genes.query(scaffold_id, np.arange(1, len(genome[scaffold_id])+1))
+	# annotate codons where each coding gene was kept
+	for i in range(len(genes)):
+		gene = genes.gene(i)
+		if gene['scaffold_id'] not in genome or gene['gene_type'] != 'CDS' or (gene['end'] - gene['start'] + 1) % 3 != 0:
+			continue
+		offset = scaffold_offsets[gene['scaffold_id']]
+		seq = genome[gene['scaffold_id']][gene['start']-1:gene['end']]
+		if gene['strand'] == '-':
+			seq = utility.rev_comp(seq.decode()).encode()
+		gene_degeneracy, gene_aas = codon_changes(seq)
+		positions = np.arange(offset+gene['start']-1, offset+gene['end'])
+		if gene['strand'] == '-': # site on + strand at gene position g is end - g; its alleles are complemented
+			positions, gene_aas = positions[::-1], gene_aas[:, ::-1]
+		kept = gene_index[positions] == i
+		degeneracy[positions[kept]] = gene_degeneracy[kept]
+		amino_acids[positions[kept]] = gene_aas[kept]
+	return {'scaffold_ids': np.array(scaffold_ids, dtype=str),
+			'offsets': offsets,
+			'gene_ids': genes.arrays['gene_id'],
+			'gene_types': np.array([locus_types.index(gene_type) for gene_type in genes.arrays['gene_type']], dtype=np.uint8),
+			'locus_types': np.array(locus_types, dtype=str),
+			'gene_index': gene_index,
+			'degeneracy': degeneracy,
+			'amino_acids': amino_acids}
+
+def write_site_annotations(fna_path, features_path, outpath):
+	""" Build annotation arrays for representative genome and write them to compressed .npz file
+		The file is replaced with a rename, so concurrent readers never see a partial file """
+	arrays = build_site_annotations(read_fasta(fna_path), read_gene_index(features_path))
+	temp_path = '%s.%s.npz' % (outpath, os.getpid())
+	try:
+		np.savez_compressed(temp_path, **arrays)
+		os.rename(temp_path, outpath)
+	finally:
+		if os.path.exists(temp_path):
+			os.remove(temp_path)
+
+class SiteAnnotations:
+	""" Look up locus_type, gene_id, site_type and amino_acids of genomic sites by array index """
+	def __init__(self, arrays):
+		self.offsets = dict(zip(arrays['scaffold_ids'], arrays['offsets'][:-1]))
+		self.lengths = dict(zip(arrays['scaffold_ids'], np.diff(arrays['offsets'])))
+		self.gene_ids = arrays['gene_ids'].astype(object)
+		self.gene_types = arrays['gene_types']
+		self.locus_types = arrays['locus_types'].astype(object)
+		self.igr = list(self.locus_types).index('IGR')
+		self.gene_index = arrays['gene_index']
+		self.degeneracy = arrays['degeneracy']
+		self.amino_acids = arrays['amino_acids']
+		self.site_types = np.array([None, '1D', '2D', '3D', '4D'], dtype=object)
+
+	def lookup(self, ref_ids, ref_pos):
+		""" Return array index of each site, -1 for sites outside of the genome """
+		index = np.full(len(ref_ids), -1, dtype=np.int64)
+		ref_pos = np.asarray(ref_pos, dtype=np.int64)
+		ref_ids = np.asarray(ref_ids, dtype=object)
+		for ref_id in set(ref_ids):
+			if ref_id in self.offsets:
+				rows = np.flatnonzero(ref_ids == ref_id)
+				inside = (ref_pos[rows] >= 1) & (ref_pos[rows] <= self.lengths[ref_id])
+				index[rows[inside]] = self.offsets[ref_id] + ref_pos[rows[inside]] - 1
+		return index
+
+	def annotate(self, ref_ids, ref_pos):
+		""" Return arrays of locus_type, gene_id, site_type, amino_acids for sites; None where not applicable """
+		index = self.lookup(ref_ids, ref_pos)
+		genes = np.where(index >= 0, self.gene_index[index.clip(0)], -1)
+		coding = genes >= 0
+		locus_type = self.locus_types[np.where(coding, self.gene_types[genes.clip(0)], self.igr)]
+		gene_id = np.where(coding, self.gene_ids[genes.clip(0)], None)
+		degeneracy = np.where(coding, self.degeneracy[index.clip(0)], 0)
+		site_type = self.site_types[degeneracy]
+		amino_acids = np.full(len(index), None, dtype=object)
+		for i in np.flatnonzero(degeneracy):
+			amino_acids[i] = ','.join(chr(aa) for aa in self.amino_acids[index[i]])
+		return locus_type, gene_id, site_type, amino_acids
+
+def repgenome_features_path(species_id, iggdb):
+	""" Path to features file of representative genome of species, plain or gzipped; None if there is none """
+	path = iggdb.get_species(species_id)['repgenome_features_path']
+	for fpath in [path, path + '.gz']:
+		if os.path.exists(fpath):
+			return fpath
+	return None
+
+def read_site_annotations(species_id, iggdb):
+	""" Load annotation arrays for representative genome of species
+		These are written to repgenomes/<genome>.annotations.npz by 'smelter annotate_repgenomes';
+		raises IOError if the file is missing, and must be rebuilt when the genome or its features change """
+	return SiteAnnotations(np.load(iggdb.get_species(species_id)['repgenome_annotations_path']))
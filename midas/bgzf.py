@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+
+# MIDAS: Metagenomic Intra-species Diversity Analysis System
+# Copyright (C) 2015 Stephen Nayfach
+# Freely distributed under the GNU General Public License (GPLv3)
+
+import io, os, gzip, zlib, struct, threading, queue, collections
+from concurrent.futures import ThreadPoolExecutor
+
+# BGZF files are a series of independent gzip members of <=64Kb each (see SAM spec, section 4.1).
+# Any gzip reader can decompress them; members can be (de)compressed in parallel.
+BLOCK_SIZE = 65280 # max uncompressed bytes per block, as in htslib
+READ_SIZE = 256 * 1024 # bytes decompressed per chunk for non-BGZF gzip files
+READAHEAD = 4 # number of decompressed chunks buffered ahead of the reader
+EOF_BLOCK = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+THREADS = min(4, os.cpu_count() or 1)
+
+_pools = {}
+
+def get_pool(threads):
+	""" Return thread pool shared by all files opened in this process """
+	key = (os.getpid(), threads) # never reuse a pool inherited through fork
+	if key not in _pools:
+		_pools[key] = ThreadPoolExecutor(threads)
+	return _pools[key]
+
+def compress_block(data, level):
+	""" Compress bytes into one BGZF block """
+	compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+	cdata = compressor.compress(data) + compressor.flush()
+	header = struct.pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(cdata) + 25)
+	footer = struct.pack('<2I', zlib.crc32(data) & 0xffffffff, len(data))
+	return header + cdata + footer
+
+def decompress_block(cdata, crc, size):
+	""" Decompress raw deflate data from one BGZF block and check its integrity """
+	data = zlib.decompress(cdata, -15)
+	if len(data) != size or zlib.crc32(data) & 0xffffffff != crc:
+		raise IOError("BGZF block failed CRC check")
+	return data
+
+def read_block_header(infile):
+	""" Read gzip member header; return size of remaining BGZF block or None if not BGZF """
+	header = infile.read(12)
+	if len(header) < 12:
+		return None
+	id1, id2, cm, flags, mtime, xfl, os_id, xlen = struct.unpack('<4BI2BH', header)
+	if (id1, id2, cm) != (31, 139, 8) or not flags & 4:
+		return None
+	extra = infile.read(xlen)
+	offset = 0
+	while offset + 4 <= len(extra):
+		si1, si2, slen = struct.unpack('<2BH', extra[offset:offset+4])
+		if (si1, si2, slen) == (66, 67, 2):
+			bsize = struct.unpack('<H', extra[offset+4:offset+6])[0]
+			return bsize + 1 - 12 - xlen
+		offset += 4 + slen
+	return None
+
+class BgzfWriter(io.RawIOBase):
+	""" Write BGZF blocks that are compressed in parallel """
+	def __init__(self, path, mode='wb', threads=THREADS, level=6):
+		self.file = io.open(path, mode)
+		self.threads = threads
+		self.level = level
+		self.pool = get_pool(threads)
+		self.buffer = bytearray()
+		self.pending = collections.deque() # compressed blocks in output order
+
+	def writable(self):
+		return True
+
+	def write(self, data):
+		self.buffer += data
+		while len(self.buffer) >= BLOCK_SIZE:
+			self.submit(bytes(self.buffer[:BLOCK_SIZE]))
+			del self.buffer[:BLOCK_SIZE]
+		return len(data)
+
+	def submit(self, data):
+		""" Queue block for compression; write finished blocks while too many are in flight """
+		try:
+			self.pending.append(self.pool.submit(compress_block, data, self.level))
+		except RuntimeError: # pool unavailable during interpreter shutdown
+			self.pending.append(compress_block(data, self.level))
+		while len(self.pending) > 2 * self.threads:
+			self.write_block()
+
+	def write_block(self):
+		""" Write oldest pending block to file """
+		block = self.pending.popleft()
+		self.file.write(block if isinstance(block, bytes) else block.result())
+
+	def close(self):
+		if self.closed:
+			return
+		try:
+			if self.buffer:
+				self.submit(bytes(self.buffer))
+				self.buffer = bytearray()
+			while self.pending:
+				self.write_block()
+			self.file.write(EOF_BLOCK)
+			self.file.close()
+		finally:
+			super(BgzfWriter, self).close()
+
+class ReadaheadReader(io.RawIOBase):
+	""" Read gzip file with decompression running on background threads
+		BGZF blocks are decompressed in parallel; other gzip files sequentially """
+	def __init__(self, path, threads=THREADS):
+		self.file = io.open(path, 'rb')
+		self.threads = threads
+		self.chunks = queue.Queue(READAHEAD)
+		self.stop = threading.Event()
+		self.chunk = b''
+		self.offset = 0
+		self.eof = False
+		self.thread = threading.Thread(target=self.decompress)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def readable(self):
+		return True
+
+	def decompress(self):
+		""" Fill queue with decompressed chunks; runs on a separate thread """
+		try:
+			with self.file as infile:
+				self.read_bgzf(infile)
+				if not self.stop.is_set():
+					self.read_gzip(infile)
+			self.chunks.put(None)
+		except Exception as e:
+			self.chunks.put(e)
+
+	def read_bgzf(self, infile):
+		""" Decompress BGZF blocks in parallel until the end of the file or a non-BGZF member """
+		pool = get_pool(self.threads)
+		pending = collections.deque()
+		while not self.stop.is_set():
+			start = infile.tell()
+			size = read_block_header(infile)
+			if size is None:
+				infile.seek(start)
+				break
+			block = infile.read(size)
+			crc, isize = struct.unpack('<2I', block[-8:])
+			if isize > 0:
+				pending.append(pool.submit(decompress_block, block[:-8], crc, isize))
+			while len(pending) > 2 * self.threads:
+				self.chunks.put(pending.popleft().result())
+		while pending and not self.stop.is_set():
+			self.chunks.put(pending.popleft().result())
+
+	def read_gzip(self, infile):
+		""" Decompress remainder of file as regular gzip """
+		if not infile.read(1):
+			return
+		infile.seek(-1, 1)
+		with gzip.GzipFile(fileobj=infile) as gzfile:
+			while not self.stop.is_set():
+				chunk = gzfile.read(READ_SIZE)
+				if not chunk: break
+				self.chunks.put(chunk)
+
+	def readinto(self, b):
+		while self.offset >= len(self.chunk):
+			if self.eof:
+				return 0
+			chunk = self.chunks.get()
+			if chunk is None:
+				self.eof = True
+				return 0
+			elif isinstance(chunk, Exception):
+				raise chunk
+			self.chunk, self.offset = chunk, 0
+		size = min(len(b), len(self.chunk) - self.offset)
+		b[:size] = self.chunk[self.offset:self.offset+size]
+		self.offset += size
+		return size
+
+	def close(self):
+		if self.closed:
+			return
+		self.stop.set()
+		while self.thread.is_alive(): # unblock decompression thread if waiting on a full queue
+			try: self.chunks.get(timeout=0.1)
+			except queue.Empty: pass
+		self.thread.join()
+		super(ReadaheadReader, self).close()
+
+def open(path, mode='r', threads=THREADS):
+	""" Open gzip file; text mode unless 'b' in mode """
+	binary = 'b' in mode
+	if mode[0] == 'r':
+		stream = io.BufferedReader(ReadaheadReader(path, threads), READ_SIZE)
+	elif mode[0] in 'wa':
+		stream = io.BufferedWriter(BgzfWriter(path, mode[0] + 'b', threads), BLOCK_SIZE)
+	else:
+		raise ValueError("Invalid mode: '%s'" % mode)
+	return stream if binary else io.TextIOWrapper(stream)
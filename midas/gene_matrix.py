@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+# MIDAS: Metagenomic Intra-species Diversity Analysis System
+# Copyright (C) 2015 Stephen Nayfach
+# Freely distributed under the GNU General Public License (GPLv3)
+
+import numpy as np
+
+# Sparse genes x samples matrices of 'merge_midas.py genes' (genes_matrix.npz with --matrix_format sparse)
+# Only entries where a gene has a non-zero copy number, depth or read count in a sample are stored, in CSR layout:
+#   indptr:  entries of gene i are indptr[i]:indptr[i+1]
+#   indices: sample (column) of each entry
+#   copynum, depth, reads: values of each entry
+# The file also holds gene_ids, sample_ids and min_copy; presence/absence is copynum >= min_copy.
+TYPES = ['copynum', 'depth', 'reads']
+
+class GeneMatrix:
+	""" Sparse genes x samples matrices of copy number, depth and read counts """
+	def __init__(self, indptr, indices, values, gene_ids=None, sample_ids=None, min_copy=None):
+		self.indptr = indptr
+		self.indices = indices
+		self.values = values # {type: array of entries}
+		self.gene_ids = gene_ids
+		self.sample_ids = sample_ids
+		self.min_copy = min_copy
+		self.shape = (len(indptr) - 1, len(sample_ids) if sample_ids is not None else int(indices.max()) + 1 if len(indices) else 0)
+
+	@classmethod
+	def from_columns(cls, ngenes, columns, **kwargs):
+		""" Build matrix from a list of (rows, {type: values}) of non-zero entries, one per sample """
+		rows = np.concatenate([column[0] for column in columns]) if columns else np.zeros(0, dtype=np.int64)
+		samples = np.repeat(np.arange(len(columns)), [len(column[0]) for column in columns])
+		order = np.argsort(rows, kind='stable') # entries of each gene stay in sample order
+		indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=ngenes))])
+		values = {}
+		for type in TYPES:
+			values[type] = np.concatenate([column[1][type] for column in columns])[order] if columns else np.zeros(0)
+		return cls(indptr, samples[order], values, **kwargs)
+
+	def entries(self, rows):
+		""" Return (index of each entry among <rows>, index of entry in arrays) for entries of <rows> """
+		starts, counts = self.indptr[rows], self.indptr[np.asarray(rows) + 1] - self.indptr[rows]
+		block_rows = np.repeat(np.arange(len(rows)), counts)
+		entries = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(starts, counts)
+		return block_rows, entries
+
+	def dense(self, type, rows):
+		""" Return dense (len(rows) x samples) array of <type> for <rows>; presabs is 1 where copynum > 0 and >= min_copy """
+		block_rows, entries = self.entries(rows)
+		values = self.values['copynum' if type == 'presabs' else type]
+		block = np.zeros((len(rows), self.shape[1]), dtype=values.dtype)
+		block[block_rows, self.indices[entries]] = values[entries]
+		if type == 'presabs':
+			return ((block > 0) & (block >= self.min_copy)).astype(int) # genes without reads are absent for any min_copy
+		return block
+
+	def subset(self, rows):
+		""" Return matrix of <rows> """
+		block_rows, entries = self.entries(rows)
+		indptr = np.concatenate([[0], np.cumsum(np.bincount(block_rows, minlength=len(rows)))])
+		values = dict([(type, self.values[type][entries]) for type in TYPES])
+		gene_ids = self.gene_ids[rows] if self.gene_ids is not None else None
+		return GeneMatrix(indptr, self.indices[entries], values, gene_ids, self.sample_ids, self.min_copy)
+
+	def save(self, path):
+		np.savez_compressed(path, indptr=self.indptr, indices=self.indices.astype(np.int32),
+			gene_ids=np.array(self.gene_ids, dtype=str), sample_ids=np.array(self.sample_ids, dtype=str),
+			min_copy=self.min_copy, **self.values)
+
+def read_gene_matrix(path):
+	""" Read genes_matrix.npz """
+	arrays = np.load(path)
+	values = dict([(type, arrays[type]) for type in TYPES])
+	return GeneMatrix(arrays['indptr'], arrays['indices'], values, arrays['gene_ids'].astype(object),
+		list(arrays['sample_ids']), float(arrays['min_copy']))
@@ -4,46 +4,80 @@
 # Copyright (C) 2015 Stephen Nayfach
 # Freely distributed under the GNU General Public License (GPLv3)
 
-import argparse, sys, os, gzip
-from collections import defaultdict
-from midas import utility
+import argparse, sys, os, gzip, numpy as np, pandas as pd
+from midas import utility, gene_matrix
 from midas.merge import merge
 
+BLOCK_CELLS = 1000000 # genes x samples formatted at once when writing matrices
+CLUSTER_PIDS = ['99', '95', '90', '85', '80', '75'] # clustering thresholds of pan-genomes in gene_info.txt
+# columns of 'run_midas.py genes' output; old field names are used instead if present
+GENE_COLUMNS = [('gene_id', 'ref_id'), ('copy_number', 'normalized_coverage'), ('coverage', 'raw_coverage')]
+
+def read_sample_genes(inpath):
+	""" Read columns of 'run_midas.py genes' output for one sample into a DataFrame """
+	genes = pd.read_csv(inpath, sep='\t', dtype={'gene_id':str, 'ref_id':str}, float_precision='round_trip')
+	for column, old_column in GENE_COLUMNS:
+		if old_column in genes:
+			genes[column] = genes[old_column] # fix old fields if present
+	if 'count_reads' not in genes:
+		genes['count_reads'] = 0
+	return genes
+
 def build_gene_matrices(sp, min_copy):
-	""" Compute gene copy numbers for samples """
-	for sample in sp.samples:
-		sample.genes = {}
-		for field, dtype in [('presabs',float), ('copynum',float), ('depth',float), ('reads',int)]:
-			sample.genes[field] = defaultdict(dtype)
+	""" Compute gene copy numbers for samples at each clustering threshold in sp.clusters, reading each sample once
+		sp.matrices[pid] holds the non-zero entries of genes x samples matrices, with one row per gene cluster """
+	columns = dict([(pid, []) for pid in sp.clusters])
+	sp.gene_rows = {}
+	for index, sample in enumerate(sp.samples):
 		inpath = '%s/genes/output/%s.genes.gz' % (sample.dir, sp.id)
-		for r in utility.parse_file(inpath):
-			if 'ref_id' in r: r['gene_id'] = r['ref_id'] # fix old fields if present
-			if 'normalized_coverage' in r: r['copy_number'] = r['normalized_coverage'] 
-			if 'raw_coverage' in r: r['coverage'] = r['raw_coverage']
-			gene_id = sp.map[r['gene_id']]
-			sample.genes['copynum'][gene_id] += float(r['copy_number'])
-			sample.genes['depth'][gene_id] += float(r['coverage'])
-			sample.genes['reads'][gene_id] += int(r['count_reads']) if 'count_reads' in r else 0
-	for sample in sp.samples:
-		for gene_id, copynum in sample.genes['copynum'].items():
-			if copynum >= min_copy: sample.genes['presabs'][gene_id] = 1
-			else: sample.genes['presabs'][gene_id] = 0
-
-def write_gene_matrices(sp):
-	""" Compute pangenome matrices to file """
+		genes = read_sample_genes(inpath)
+		centroids = sp.centroids.get_indexer(genes['gene_id'])
+		if (centroids < 0).any():
+			sys.exit("\nError: gene %s in %s not found in %s\n" % (genes['gene_id'][np.argmax(centroids < 0)], inpath, sp.gene_info))
+		for pid, (gene_ids, centroid_rows) in sp.clusters.items():
+			rows = centroid_rows[centroids]
+			# sum genes of each cluster, in input order; keep clusters with non-zero values
+			values = {}
+			for type, column in [('copynum', 'copy_number'), ('depth', 'coverage'), ('reads', 'count_reads')]:
+				values[type] = np.bincount(rows, weights=genes[column].values.astype(float), minlength=len(gene_ids))
+			values['reads'] = values['reads'].astype(np.int32)
+			nonzero = np.flatnonzero((values['copynum'] != 0) | (values['depth'] != 0) | (values['reads'] != 0))
+			columns[pid].append((nonzero, dict([(type, values[type][nonzero]) for type in values])))
+			if index == 0: # genes are written if found in first sample
+				sp.gene_rows[pid] = np.flatnonzero(np.bincount(rows, minlength=len(gene_ids)))
+	sp.matrices = {}
+	for pid, (gene_ids, centroid_rows) in sp.clusters.items():
+		sp.matrices[pid] = gene_matrix.GeneMatrix.from_columns(len(gene_ids), columns[pid],
+			gene_ids=gene_ids, sample_ids=[s.id for s in sp.samples], min_copy=min_copy)
+
+def matrix_dir(sp, pid):
+	""" Output directory for matrices at <pid>; a subdirectory per threshold if several were requested """
+	return sp.dir if len(sp.clusters) == 1 else '%s/centroid_%s' % (sp.dir, pid)
+
+def write_gene_matrices(sp, matrix_format='text'):
+	""" Compute pangenome matrices to file; genes_matrix.npz replaces genes_*.txt with --matrix_format sparse """
+	for pid in sp.clusters:
+		outdir = matrix_dir(sp, pid)
+		if not os.path.isdir(outdir): os.mkdir(outdir)
+		write_pid_matrices(sp.matrices[pid], sp.gene_rows[pid], outdir, matrix_format)
+
+def write_pid_matrices(matrix, gene_rows, outdir, matrix_format):
+	""" Write matrices of one clustering threshold """
+	if matrix_format == 'sparse':
+		matrix.subset(gene_rows).save('%s/genes_matrix.npz' % outdir)
+		return
 	# open outfiles
 	outfiles = {}
 	for type in ['presabs', 'copynum', 'depth', 'reads']:
-		outfiles[type] = open('%s/genes_%s.txt' % (sp.dir, type), 'w')
-		outfiles[type].write('\t'.join(['gene_id'] + [s.id for s in sp.samples])+'\n')
-	# write values
-	genes = sorted(sp.samples[0].genes['depth'])
-	for gene_id in genes:
+		outfiles[type] = open('%s/genes_%s.txt' % (outdir, type), 'w')
+		outfiles[type].write('\t'.join(['gene_id'] + matrix.sample_ids)+'\n')
+	# write values for blocks of genes
+	fmt = '%s' + '\t%s' * len(matrix.sample_ids) + '\n'
+	block_genes = max(1, BLOCK_CELLS // max(1, len(matrix.sample_ids)))
+	for start in range(0, len(gene_rows), block_genes):
+		rows = gene_rows[start:start+block_genes]
 		for type in ['presabs', 'copynum', 'depth', 'reads']:
-			outfiles[type].write(gene_id)
-			for sample in sp.samples:
-				outfiles[type].write('\t%s' % str(sample.genes[type][gene_id]))
-			outfiles[type].write('\n')
+			outfiles[type].write(merge.format_rows([matrix.gene_ids[rows]] + list(matrix.dense(type, rows).T), fmt))
 	for outfile in outfiles.values():
 		outfile.close()
 
@@ -66,6 +100,11 @@ genes_reads.txt
   number of reads mapped to each gene per sample
 genes_summary.txt
   alignment summary statistics per sample
+centroid_<pid>/
+  with several values of --cluster_pid, the gene matrices for each clustering threshold are written to a subdirectory
+genes_matrix.npz
+  written instead of genes_depth.txt, genes_copynum.txt, genes_presabs.txt and genes_reads.txt with --matrix_format sparse
+  non-zero copy-number, depth and read counts of genes per sample; read with midas.gene_matrix.read_gene_matrix
 
 Output formats
 ############
@@ -88,14 +127,57 @@ Additional information for species can be found in the reference database:
 """ % (args['db'], sp.id) )
 	outfile.close()
 
-def read_cluster_map(sp, db, pid):
-	sp.map = {}
+def build_cluster_map(gene_info):
+	""" Map centroid_99 genes to gene clusters at each clustering threshold in <gene_info>
+		Returns arrays of centroid_99 ids and, for each threshold, sorted ids of clusters and the cluster of each centroid_99 """
+	clusters = pd.read_csv(gene_info, sep='\t', dtype=str)
+	clusters = clusters.drop_duplicates('centroid_99', keep='last')
+	arrays = {'centroids': np.asarray(clusters['centroid_99'], dtype=str)}
+	for pid in CLUSTER_PIDS:
+		gene_ids = np.array(sorted(set(clusters['centroid_%s' % pid])), dtype=str)
+		arrays['gene_ids_%s' % pid] = gene_ids
+		arrays['rows_%s' % pid] = np.searchsorted(gene_ids, np.asarray(clusters['centroid_%s' % pid], dtype=str)).astype(np.int32)
+	return arrays
+
+def read_cluster_map(sp, db, pids):
+	""" Map centroid_99 genes to gene clusters at each threshold in <pids>
+		sp.centroids: centroid_99 ids; sp.clusters[pid]: (sorted ids of clusters, row of cluster for each centroid_99)
+		The maps are cached as integer arrays next to gene_info.txt and rebuilt when it changes """
 	for ext in ['', '.gz']:
 		path = '/'.join([db, 'pan_genomes', sp.id, 'gene_info.txt%s' % ext])
 		if os.path.isfile(path):
 			sp.gene_info = path
-	for r in utility.parse_file(sp.gene_info):
-		sp.map[r['centroid_99']] =  r['centroid_%s' % pid]
+	cache_path = '%s.clusters.npz' % sp.gene_info
+	if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(sp.gene_info):
+		arrays = np.load(cache_path)
+	else:
+		arrays = build_cluster_map(sp.gene_info)
+		try:
+			np.savez(cache_path, **arrays)
+		except (IOError, OSError): # e.g. read-only database
+			pass
+	sp.centroids = pd.Index(arrays['centroids'].astype(object))
+	sp.clusters = {}
+	for pid in pids:
+		sp.clusters[pid] = (arrays['gene_ids_%s' % pid].astype(object), arrays['rows_%s' % pid])
+
+def matrix_memory(sp, pids):
+	""" Estimate peak bytes used to merge species: non-zero entries of copynum, depth and reads at each threshold, plus one sample's genes """
+	entries = sum(int(sample.info[sp.id]['covered_genes']) for sample in sp.samples)
+	pangenome_size = max(int(sample.info[sp.id]['pangenome_size']) for sample in sp.samples)
+	return 2 * len(pids) * entries * (8 + 8 + 4 + 4 + 8) + pangenome_size * 200
+
+def merge_species(species, args):
+	""" Merge gene matrices of one species; runs in a worker process """
+	species.dir = os.path.join(args['outdir'], species.id)
+	if not os.path.isdir(species.dir): os.mkdir(species.dir)
+	read_cluster_map(species, args['db'], args['cluster_pid'])
+	print("  %s: building pangenome matrices" % species.id)
+	build_gene_matrices(species, min_copy=args['min_copy'])
+	write_gene_matrices(species, args['matrix_format'])
+	species.write_sample_info(dtype='genes', outdir=args['outdir'])
+	write_readme(args, species)
+	print("  %s: done" % species.id)
 
 def run_pipeline(args):
 
@@ -107,22 +189,10 @@ def run_pipeline(args):
 		print("    count samples: %s" % len(species.samples))
 		
 	print("\nMerging genes")
+	# species are merged concurrently, largest first, as long as their matrices fit in memory
+	scheduler = utility.Scheduler(args['threads'], max_memory=args['max_memory'] * 1024**3 if args['max_memory'] else None)
 	for species in species_list:
-			
-		print("  %s" % species.id)
-		species.dir = os.path.join(args['outdir'], species.id)
-		if not os.path.isdir(species.dir): os.mkdir(species.dir)
-		read_cluster_map(species, args['db'], args['cluster_pid'])
-			
-		print("    building pangenome matrices")
-		build_gene_matrices(species, min_copy=args['min_copy'])
-		write_gene_matrices(species)
-
-		print("    writing summary statistics")
-		species.write_sample_info(dtype='genes', outdir=args['outdir'])
-
-		write_readme(args, species)
-		
-		print("    done!")
-
+		memory = matrix_memory(species, args['cluster_pid'])
+		scheduler.add(merge_species, (species, args), priority=(-len(species.samples), -memory), files=5, memory=memory)
+	scheduler.run()
 
@@ -4,9 +4,17 @@
 # Copyright (C) 2015 Stephen Nayfach
 # Freely distributed under the GNU General Public License (GPLv3)
 
-import os, sys, csv
+import os, sys, csv, json, numpy as np, pandas as pd
 from midas import utility
 
+def format_rows(columns, fmt):
+	""" Format table given as a list of equal-length columns with a single string operation """
+	nrows = len(columns[0])
+	cells = np.empty((nrows, len(columns)), dtype=object)
+	for index, column in enumerate(columns):
+		cells[:, index] = column
+	return (fmt * nrows) % tuple(cells.ravel().tolist())
+
 class Species:
 	""" Base class for species """
 	def __init__(self, id, species_info, genome_info):
@@ -58,10 +66,10 @@ class Species:
 
 class Sample:
 	""" Base class for samples """
-	def __init__(self, dir, data_type):
+	def __init__(self, dir, data_type, info=None):
 		self.dir = dir
 		self.id = os.path.basename(self.dir)
-		self.info = self.read_info(data_type)
+		self.info = self.read_info(data_type) if info is None else info
 
 	def read_info(self, data_type):
 		path = '%s/%s/summary.txt' % (self.dir, data_type)
@@ -73,16 +81,57 @@ class Sample:
 		else:
 			return None
 
-def init_samples(indirs, data_type):
-	""" Initialize samples """
+def sample_cache_path(outdir, data_type):
+	return '%s/.%s_samples.json' % (outdir, data_type)
+
+def read_sample_cache(path):
+	""" Return {summary path: [mtime, {species_id: row}]} from previous runs; empty if missing or unreadable """
+	try:
+		with open(path) as infile:
+			return json.load(infile)
+	except (IOError, OSError, ValueError):
+		return {}
+
+def write_sample_cache(path, cache):
+	""" Write sample cache atomically; ignored if the output directory is not writable """
+	try:
+		with open(path + '.tmp', 'w') as outfile:
+			json.dump(cache, outfile)
+		os.rename(path + '.tmp', path)
+	except (IOError, OSError):
+		pass
+
+def scan_summary(path, cache):
+	""" Return [mtime, {species_id: row}] of summary file, reusing cached rows if it is unchanged; None if missing """
+	try:
+		mtime = os.path.getmtime(path)
+	except OSError:
+		return None
+	if path in cache and cache[path][0] == mtime:
+		return cache[path]
+	info = {}
+	with open(path) as infile:
+		for r in csv.DictReader(infile, delimiter='\t'):
+			info[r['species_id']] = r
+	return [mtime, info]
+
+def init_samples(indirs, data_type, threads=1, cache_path=None):
+	""" Initialize samples; summary files are read concurrently by <threads> threads
+		and cached in <cache_path> by path and mtime, so unchanged samples are not re-read by later runs """
+	from concurrent.futures import ThreadPoolExecutor
+	cache = read_sample_cache(cache_path) if cache_path else {}
+	paths = [os.path.abspath('%s/%s/summary.txt' % (dir, data_type)) for dir in indirs]
+	with ThreadPoolExecutor(max(1, threads)) as pool:
+		summaries = list(pool.map(lambda path: scan_summary(path, cache), paths))
 	samples = []
-	for dir in indirs:
-		sample = Sample(dir, data_type)
-		if sample.info is None:
-			pass
+	for dir, path, summary in zip(indirs, paths, summaries):
+		if summary is None:
 			sys.stderr.write("Warning: missing/incomplete output: %s\n" % dir)
 		else:
-			samples.append(sample)
+			cache[path] = summary
+			samples.append(Sample(dir, data_type, info=summary[1]))
+	if cache_path:
+		write_sample_cache(cache_path, cache)
 	return samples
 
 def read_species_info(iggdb):
@@ -93,22 +142,26 @@ def read_genome_info(iggdb):
 	""" Read genome annotations """
 	return iggdb.genomes
 
-def filter_sample_species(sample, species, species_id, args, dtype):
-	""" Determine whether sample-species pair fails filters """
-	info = sample.info[species_id]
-	if (args['species_id']
-			and species_id not in args['species_id'].split(',')):
-		return True # skip unspecified species
-	elif (args['max_samples']
-			and species_id in species
-			and len(species[species_id].samples) >= args['max_samples']):
-		return True # skip species with too many samples
-	elif float(info['mean_coverage']) < args['sample_depth']:
-		return True # skip low-coverage sample
-	elif dtype=='snps' and float(info['fraction_covered']) < args['fract_cov']:
-		return True # skip low-coverage sample
-	else:
-		return False
+def sample_species_table(samples):
+	""" Return table of sample-species pairs: sample (index into samples), species_id, mean_coverage, fraction_covered """
+	records = [(index, species_id, info['mean_coverage'], info['fraction_covered'])
+		for index, sample in enumerate(samples) for species_id, info in sample.info.items()]
+	table = pd.DataFrame(records, columns=['sample', 'species_id', 'mean_coverage', 'fraction_covered'])
+	for column in ['mean_coverage', 'fraction_covered']:
+		table[column] = table[column].astype(float)
+	return table
+
+def filter_sample_species(table, args, dtype):
+	""" Return mask of sample-species pairs in <table> that pass filters """
+	keep = table['mean_coverage'] >= args['sample_depth'] # skip low-coverage samples
+	if args['species_id']:
+		keep &= table['species_id'].isin(args['species_id'].split(',')) # skip unspecified species
+	if dtype == 'snps':
+		keep &= table['fraction_covered'] >= args['fract_cov'] # skip low-coverage samples
+	if args['max_samples']:
+		# keep first max_samples samples of each species
+		keep[keep] = table[keep].groupby('species_id').cumcount() < args['max_samples']
+	return keep
 
 def sort_species(species):
 	""" Sort list of species by number of samples in descending order """
@@ -120,12 +173,12 @@ def init_species(samples, args, dtype):
 	species = {}
 	species_info = read_species_info(args['iggdb'])
 	genome_info = read_genome_info(args['iggdb'])
-	for sample in samples:
-		for species_id in sample.info:
-			if species_id not in species:
-				species[species_id] = Species(species_id, species_info, genome_info)
-			if not filter_sample_species(sample, species, species_id, args, dtype):
-				species[species_id].samples.append(sample)
+	table = sample_species_table(samples)
+	for species_id in table['species_id'].unique():
+		species[species_id] = Species(species_id, species_info, genome_info)
+	kept = table[filter_sample_species(table, args, dtype)]
+	for species_id, sample in zip(kept['species_id'], kept['sample']):
+		species[species_id].samples.append(samples[sample])
 	return list(species.values())
 
 def filter_species(species, args):
@@ -146,7 +199,7 @@ def filter_species(species, args):
 
 def select_species(args, dtype):
 	""" Select all species with a minimum number of high-coverage samples"""
-	samples = init_samples(args['indirs'], dtype)
+	samples = init_samples(args['indirs'], dtype, args['threads'], sample_cache_path(args['outdir'], dtype))
 	species = init_species(samples, args, dtype)
 	species = filter_species(species, args)
 	return species
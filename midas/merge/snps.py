@@ -4,283 +4,489 @@
 # Copyright (C) 2015 Stephen Nayfach
 # Freely distributed under the GNU General Public License (GPLv3)
 
-import sys, os, shutil
-from midas import utility
+import sys, os, re, shutil, itertools, heapq, numpy as np, pandas as pd
+from midas import utility, annotation, snps_matrix
 from midas.merge import merge
 from time import time
-from operator import itemgetter
 import multiprocessing
 from smelter.iggdb import IGGdb
 from smelter.utilities import tserr
 import traceback
 
-class GenomicSite:
-	def __init__(self, id, values):
+CHUNK_SITES = 1000000 # rows of each sample's .snps.gz parsed at once
+BLOCK_CELLS = 1000000 # sites x samples processed at once when calling SNPs
+INDEX_SITES = 10000 # sites between entries in byte-offset index of site list
+ALLELES = np.array(['A', 'C', 'G', 'T'], dtype=object)
+ALLELE_COUNTS = ['count_a', 'count_c', 'count_g', 'count_t'] # columns of run_midas.py snps output
+SNP_TYPES = np.array([None, 'mono', 'bi', 'tri', 'quad'], dtype=object) # indexed by number of alleles
+SPARSE_FANIN = 256 # sparse files joined at once; larger batches are joined in groups, then across groups
+SPARSE_ENTRY = np.dtype([('row', np.int64), ('column', np.int32), ('counts', np.uint32, 4)]) # non-zero counts of a sample at a joined site
+
+class SiteBlock:
+	""" Block of consecutive genomic sites; per-site statistics are arrays with one entry per site """
+	def __init__(self, sites, sample_counts, pooled_counts):
 	
 		# initialize
-		self.id = str(id) #values[0].rsplit('|', 1)[0]
-		self.ref_id, self.ref_pos, self.ref_allele  = values[0].rsplit('|', 2)
-		self.ref_pos = int(self.ref_pos)
+		self.ids = np.array([int(site[0]) for site in sites], dtype=np.int64)
+		self.ref_ids = [site[1] for site in sites]
+		self.ref_pos = [int(site[2]) for site in sites]
+		self.ref_alleles = [site[3] for site in sites]
 		
 		# per-sample statistics
-		self.sample_counts = [[int(j) for j in i.split(',')] for i in values[1:]] # <list>, per sample allele counts
-		self.sample_mafs = []  # <list>, minor allele frequencies
-		self.sample_depths = [] # <list>, count of major+minor allele frequencies
+		self.sample_counts = sample_counts # <array>, sites x samples x 4 allele counts
+		self.sample_mafs = None  # <array>, sites x samples minor allele frequencies
+		self.sample_depths = None # <array>, sites x samples count of major+minor alleles
 		
 		# pooled statistics
-		self.total_samples = len(self.sample_counts)
-		self.pooled_counts = self.compute_pooled_counts() # <list>, count of each allele across all samples
-		self.pooled_depth = sum(self.pooled_counts)
-		self.major_allele = None
-		self.minor_allele = None
+		self.total_samples = sample_counts.shape[1]
+		self.pooled_counts = pooled_counts # <array>, sites x 4 counts across samples
+		self.pooled_depth = self.pooled_counts.sum(axis=1)
+		self.major_index = None
+		self.minor_index = None
 		self.snp_type = None # mono, bi, tri, quad
-					
+		
 		# site annotations
-		self.locus_type = None # CDS, tRNA, rRNA, IGR
-		self.site_type = None # 1D, 2D, 3D, 4D
-		self.gene_id = None
-		self.amino_acids = None
-		self.ref_codon = None
-		self.codon_pos = None
+		self.locus_type = np.full(len(sites), None, dtype=object) # CDS, tRNA, rRNA, IGR
+		self.site_type = np.full(len(sites), None, dtype=object) # 1D, 2D, 3D, 4D
+		self.gene_id = np.full(len(sites), None, dtype=object)
+		self.amino_acids = np.full(len(sites), None, dtype=object)
 		
-	def compute_pooled_counts(self):
-		""" Compute count of 4 nucleotides across samples """
-		pooled_counts = []
-		for i in range(4):
-			pooled_counts.append(sum([counts[i] for counts in self.sample_counts]))
-		return pooled_counts
-
 	def call_alleles(self, snp_freq):
-		""" Call major and minor alleles at GenomicSite """
-		
-		# check at least 1 mapped read
-		if self.pooled_depth == 0: return
-		
-		# get sorted counts
-		alleles = list('ACGT')
-		freqs = [float(count)/self.pooled_depth for count in self.pooled_counts]
-		allele_freqs = sorted(zip(alleles, freqs), key=itemgetter(1), reverse=True)
-
-		# major allele
-		if allele_freqs[0][1] > 0:
-			self.major_allele = allele_freqs[0][0]
-			self.major_index = alleles.index(self.major_allele)
+		""" Call major and minor alleles at each site """
+		# sort alleles by pooled count; ties keep ACGT order
+		order = np.argsort(-self.pooled_counts, axis=1, kind='stable')
+		sorted_counts = np.take_along_axis(self.pooled_counts, order, axis=1)
+		self.major_index = np.where(sorted_counts[:, 0] > 0, order[:, 0], -1)
+		self.minor_index = np.where(sorted_counts[:, 1] > 0, order[:, 1], -1)
 		
-		# minor allele
-		if allele_freqs[1][1] > 0:
-			self.minor_allele = allele_freqs[1][0]
-			self.minor_index = alleles.index(self.minor_allele)
-		
-		# classify SNP
-		snp_types = ['quad', 'tri', 'bi', 'mono']
-		for snp_type, allele_freq in zip(snp_types, allele_freqs[::-1]):
-			allele, freq = allele_freq
-			if freq >= snp_freq:
-				self.snp_type = snp_type
-				break
+		# classify SNP by number of alleles with pooled frequency >= snp_freq
+		with np.errstate(invalid='ignore', divide='ignore'):
+			freqs = self.pooled_counts / self.pooled_depth[:, None].astype(float)
+		count_alleles = np.where(self.pooled_depth > 0, (freqs >= snp_freq).sum(axis=1), 0)
+		self.snp_type = SNP_TYPES[count_alleles]
 
 	def compute_per_sample_mafs(self):
-		""" Compute per-sample depth (major + minor allele) and minor allele freq at GenomicSite """
-		if self.major_allele is None:
-			self.sample_mafs = [0.0 for counts in self.sample_counts]
-			self.sample_depths = [0 for counts in self.sample_counts]
-		elif self.minor_allele is None:
-			self.sample_mafs = [0.0 for counts in self.sample_counts]
-			self.sample_depths = [counts[self.major_index] for counts in self.sample_counts]
-		else:
-			for counts in self.sample_counts:
-				sample_depth = counts[self.major_index] + counts[self.minor_index]
-				sample_maf = float(counts[self.minor_index])/sample_depth if sample_depth > 0 else 0.0
-				self.sample_mafs.append(sample_maf)
-				self.sample_depths.append(sample_depth)
+		""" Compute per-sample depth (major + minor allele) and minor allele freq at each site """
+		major_counts = np.take_along_axis(self.sample_counts, self.major_index.clip(0)[:, None, None], axis=2)[:, :, 0].astype(np.int64)
+		minor_counts = np.take_along_axis(self.sample_counts, self.minor_index.clip(0)[:, None, None], axis=2)[:, :, 0].astype(np.int64)
+		major_counts[self.major_index < 0] = 0
+		minor_counts[self.minor_index < 0] = 0
+		self.sample_depths = major_counts + minor_counts
+		with np.errstate(invalid='ignore', divide='ignore'):
+			self.sample_mafs = np.where(self.sample_depths > 0, minor_counts / self.sample_depths.astype(float), 0.0)
 
 	def compute_prevalence(self, mean_depths, min_depth, max_ratio):
-		""" Compute the fraction of samples where site passes all filters """
-		pass_qc = []
-		for mean_depth, site_depth in zip(mean_depths, self.sample_depths):
-			if site_depth < min_depth:
-				pass_qc.append(0)
-			elif site_depth/mean_depth > max_ratio:
-				pass_qc.append(0)
-			else:
-				pass_qc.append(1)
-		self.count_samples = sum(pass_qc)
-		self.prevalence = sum(pass_qc)/float(len(pass_qc))
+		""" Compute the fraction of samples where each site passes all filters """
+		with np.errstate(invalid='ignore', divide='ignore'):
+			ratios = self.sample_depths / np.asarray(mean_depths, dtype=float)
+		pass_qc = (self.sample_depths >= min_depth) & ~(ratios > max_ratio)
+		self.count_samples = pass_qc.sum(axis=1)
+		self.prevalence = self.count_samples / float(self.total_samples)
 
 	def flag(self, min_prev, snp_types):
-		""" Filter genomic site based on MAF and prevalence """
-		if self.prevalence < min_prev:
-			self.flag = (True, 'min_prev')
-		elif ('any' not in snp_types and 
-				self.snp_type not in snp_types):
-			self.flag = (True, 'snp_type')
-		else:
-			self.flag = (False, None)
+		""" Filter genomic sites based on MAF and prevalence; sets boolean array of sites to keep """
+		self.keep = ~(self.prevalence < min_prev)
+		if 'any' not in snp_types:
+			self.keep &= np.isin(self.snp_type, snp_types)
+
+	def annotate(self, annotations):
+		""" Annotate kept sites using precomputed per-position arrays of representative genome """
+		keep = np.flatnonzero(self.keep)
+		ref_ids, ref_pos = [self.ref_ids[i] for i in keep], [self.ref_pos[i] for i in keep]
+		self.locus_type[keep], self.gene_id[keep], self.site_type[keep], self.amino_acids[keep] = annotations.annotate(ref_ids, ref_pos)
 
-	def annotate(self, genes):
-		""" Annotate variant and reference site """
-		# genes = {'list': list of genes, 'index':index position in list}
-		# each element in 'list' is sorted by scaffold_id (asc), start (asc), end (desc)
-		# each element is a dictionary with gene info
-		while True:
-			# 1. fetch next gene
-			#    if there are no more genes, snp must be intergenic so break
-			if genes['index'] < len(genes['list']):
-				gene = genes['list'][genes['index']]
-			else:
-				self.locus_type = 'IGR'
-				return
-			# 2. if snp is upstream of next gene, snp must be intergenic so break
-			if (self.ref_id < gene['scaffold_id'] or
-			   (self.ref_id == gene['scaffold_id'] and self.ref_pos < gene['start'])):
-				self.locus_type = 'IGR'
-				return
-			# 3. if snp is downstream of next gene, pop gene, check (1) and (2) again
-			if (self.ref_id > gene['scaffold_id'] or
-			   (self.ref_id == gene['scaffold_id'] and self.ref_pos > gene['end'])):
-				genes['index'] += 1
-				continue
-			# 4. snp in coding gene: annotate (1D-4D)
-			elif gene['gene_type'] == 'CDS':
-				self.locus_type = gene['gene_type']
-				self.gene_id = gene['gene_id']
-				if len(gene['seq']) % 3 != 0: # gene must by divisible by 3 to id codons
-					return
-				self.ref_codon, self.codon_pos = self.fetch_ref_codon(gene)
-				if not all([_ in ['A','T','C','G'] for _ in self.ref_codon]): # codon can't contain weird characters
-					return
-				self.amino_acids = []
-				for allele in ['A','C','G','T']: # + strand
-					codon = utility.index_replace(self.ref_codon, allele, self.codon_pos, gene['strand']) # +/- strand
-					amino_acid = utility.translate(codon)
-					self.amino_acids.append(amino_acid)
-				unique_aa = set(self.amino_acids)
-				degeneracy = 4 - len(unique_aa) + 1
-				self.site_type = '%sD' % degeneracy
-				self.amino_acids = ','.join(self.amino_acids)
-				# AA's identical: degeneracy = 4 - 1 + 1 = 4
-				# AA's all different, degeneracy = 4 - 4 + 1 = 1
-				return
-			# 5. snp in non-coding gene
-			else:
-				self.locus_type = gene['gene_type']
-				self.gene_id = gene['gene_id']
-				return
-
-	def fetch_ref_codon(self, gene):
-		""" Fetch codon within gene for given site """
-		# position of site in gene
-		gene_pos = self.ref_pos - gene['start'] if gene['strand'] == '+' else gene['end'] - self.ref_pos
-		# position of site in codon
-		codon_pos = gene_pos % 3
-		# gene sequence (oriented start to stop)
-		ref_codon = gene['seq'][gene_pos-codon_pos:gene_pos-codon_pos+3]
-		return ref_codon, codon_pos
-						
 	def write(self, files):
-		""" Store data for GenomicSite in Species"""
+		""" Write kept sites to snps_info, snps_freq and snps_depth files """
+		keep = np.flatnonzero(self.keep)
+		if len(keep) == 0:
+			return
+		ids = self.ids[keep]
 		# snps_info
-		count_a, count_c, count_g, count_t = [str(_) for _ in self.pooled_counts]
-		info = [self.id,
-				self.ref_id,
-				str(self.ref_pos),
-				self.ref_allele,
-				self.major_allele,
-				self.minor_allele,
-				str(self.count_samples),
-				count_a, count_c, count_g, count_t,
-				self.locus_type,
-				self.gene_id,
-				self.snp_type,
-				self.site_type,
-				self.amino_acids,
+		info = [ids,
+				[self.ref_ids[i] for i in keep],
+				[self.ref_pos[i] for i in keep],
+				[self.ref_alleles[i] for i in keep],
+				allele_names(self.major_index[keep]),
+				allele_names(self.minor_index[keep]),
+				self.count_samples[keep],
+				self.pooled_counts[keep, 0],
+				self.pooled_counts[keep, 1],
+				self.pooled_counts[keep, 2],
+				self.pooled_counts[keep, 3],
+				self.locus_type[keep],
+				self.gene_id[keep],
+				self.snp_type[keep],
+				self.site_type[keep],
+				self.amino_acids[keep],
 				]
-		info = '\t'.join([replace_none(_) for _ in info])+'\n'
-		files['info'].write(info)
+		info = [replace_none(column) for column in info]
+		files['info'].write(merge.format_rows(info, '\t'.join(['%s']*len(info))+'\n'))
+		# snps_matrix.bin replaces snps_freq and snps_depth with --matrix_format binary
+		if 'matrix' in files:
+			minor_counts = np.rint(self.sample_mafs[keep] * self.sample_depths[keep])
+			files['matrix'].write_block(ids, minor_counts, self.sample_depths[keep])
+			return
 		# snps_freq
-		freq = self.id + '\t' + '\t'.join(['{0:.3g}'.format(freq) for freq in self.sample_mafs])+'\n'
-		files['freq'].write(freq)
+		fmt = '%s' + '\t%.3g' * self.total_samples + '\n'
+		files['freq'].write(merge.format_rows([ids] + list(self.sample_mafs[keep].T), fmt))
 		# snps_depth
-		depth = self.id + '\t' + '\t'.join([str(depth) for depth in self.sample_depths])+'\n'
-		files['depth'].write(depth)
-
-
-def parallel(function, argument_list, threads):
-	mp = multiprocessing.Pool(threads)
-	return mp.starmap(function, argument_list)
-
-
-def replace_none(input_string, replace_string="NA"):
-	return input_string if input_string is not None else replace_string
-
-def read_run_midas_snps(species_id, samples):
-	""" Open SNP files for species across samples """
-	infiles = []
-	for sample in samples:
-		path = '%s/snps/output/%s.snps.gz' % (sample.dir, species_id)
-		file = utility.iopen(path)
-		next(file)
-		infiles.append(file)
-	return infiles
-
-def build_temp_count_matrix(tempdir, species_id, samples, split_num, max_sites):
-	""" Build SNP matrices using a subset of total samples """
-	sample_ids = [s.id for s in samples]
-	midas_files = read_run_midas_snps(species_id, samples)
-	matrix_file = open('%s/acgt_counts.%s.txt' % (tempdir, split_num), 'w')
-	matrix_file.write('\t'.join(['site_id']+sample_ids)+'\n')
+		fmt = '%s' + '\t%s' * self.total_samples + '\n'
+		files['depth'].write(merge.format_rows([ids] + list(self.sample_depths[keep].T), fmt))
+
+def allele_names(indexes):
+	""" Convert array of allele indexes (-1 for none) to list of A, C, G, T or None """
+	names = ALLELES[indexes.clip(0)]
+	names[indexes < 0] = None
+	return names
+
+def replace_none(values, replace_string="NA"):
+	return [value if value is not None else replace_string for value in values]
+
+def run_midas_snps_path(sample, species_id):
+	""" Path to output of 'run_midas.py snps' for species in sample """
+	return '%s/snps/output/%s.snps.gz' % (sample.dir, species_id)
+
+def read_run_midas_snps(path, columns, dtype, max_sites, skip_sites=0, chunk_sites=CHUNK_SITES):
+	""" Yield DataFrames with <columns> for chunks of sites from SNP file, starting after <skip_sites> sites
+		DataFrames are indexed by site number in the file """
+	nrows = None if max_sites == float('Inf') else int(max_sites)
+	with utility.iopen(path, 'rb') as infile:
+		header = infile.readline().decode('utf-8').rstrip('\n').split('\t')
+		for line in itertools.islice(infile, skip_sites):
+			pass
+		for chunk in pd.read_csv(infile, sep='\t', names=header, header=None, usecols=columns, dtype=dtype,
+				nrows=nrows, chunksize=chunk_sites, na_filter=False):
+			chunk.index += skip_sites
+			yield chunk
+
+def count_run_midas_snps(path, max_sites):
+	""" Count sites in SNP file """
+	with utility.iopen(path, 'rb') as infile:
+		nsites = sum(1 for line in infile) - 1
+	return min(nsites, max_sites)
+
+def parse_region(region):
+	""" Parse 'contig:start-end' or 'contig' into (ref_id, start, end); positions are 1-based and inclusive """
+	ref_id, _, positions = region.rpartition(':')
+	if not ref_id or '-' not in positions:
+		return region, 1, float('Inf')
+	start, end = positions.split('-')
+	return ref_id, int(start), int(end)
+
+def parse_shard(shard):
+	""" Parse 'i/N' into (i, N), where shards are numbered from 1 """
+	shard, shards = [int(_) for _ in shard.split('/')]
+	return shard, shards
+
+def shard_name(args):
+	""" Name of directory with outputs for --region or --shard; None if all sites are merged """
+	if args['region']:
+		return 'region_%s' % re.sub('[^A-Za-z0-9._-]', '_', args['region'])
+	elif args['shard']:
+		return 'shard_%s_of_%s' % parse_shard(args['shard'])
+	else:
+		return None
+
+def select_sites(sites, args, total_sites):
+	""" Return boolean mask of sites (DataFrame indexed by site number) in --region or --shard """
+	if args['region']:
+		ref_id, start, end = parse_region(args['region'])
+		positions = sites['ref_pos'].astype(np.int64)
+		return ((sites['ref_id'] == ref_id) & (positions >= start) & (positions <= end)).values
+	elif args['shard']:
+		shard, shards = parse_shard(args['shard'])
+		first, last = (shard - 1) * total_sites // shards, shard * total_sites // shards
+		return (sites.index >= first) & (sites.index < last)
+	else:
+		return np.ones(len(sites), dtype=bool)
+
+def write_site_list(species, args):
+	""" Write site_id, ref_id, ref_pos, ref_allele of each selected site to temp dir
+		Return number of sites, site index and number of the first site in the input files
+		Dense inputs list the same sites in the same order, so the first sample is used
+		The index holds the byte offset of every INDEX_SITES-th site so shards can seek to their first site """
+	if args['sparse']:
+		chunks = join_sparse_sites(species, args)
+	else:
+		path = run_midas_snps_path(species.samples[0], species.id)
+		total_sites = count_run_midas_snps(path, args['max_sites']) if args['shard'] else None
+		chunks = (chunk[select_sites(chunk, args, total_sites)] for chunk in
+			read_run_midas_snps(path, ['ref_id', 'ref_pos', 'ref_allele'], str, args['max_sites']))
+	outfile = open('%s/acgt_sites.txt' % species.countdir, 'wb')
 	nsites = 0
-	while True:
-		records = []
-		for file in midas_files:
-			try:
-				record = next(file).rstrip('\n').split('\t')
-				records.append(record)
-			except StopIteration:
-				matrix_file.close()
-				for file in midas_files: file.close()
-				return
-		if nsites >= max_sites:
-			matrix_file.close()
-			for file in midas_files: file.close()
-			return
-		else:
-			nsites += 1
-			site_id = '|'.join(records[0][0:3])
-			allele_counts = [','.join(r[-4:]) for r in records]
-			matrix_file.write(site_id+'\t'+'\t'.join(allele_counts)+'\n')
-
-def parallel_build_temp_count_matrixes(species, args):
-	""" Split up samples into batches, merge each batch, merge together batches """
+	first_site = 0
+	offsets = [np.zeros(1, dtype=np.int64)]
+	for chunk in chunks:
+		if nsites == 0 and len(chunk) > 0:
+			first_site = int(chunk.index[0])
+		site_ids = pd.Series(chunk.index + 1, index=chunk.index).astype(str)
+		lines = (site_ids + '\t' + chunk['ref_id'] + '\t' + chunk['ref_pos'] + '\t' + chunk['ref_allele'] + '\n').str.encode('utf-8')
+		ends = offsets[-1][-1] + np.cumsum(lines.str.len().values, dtype=np.int64)
+		outfile.write(b''.join(lines))
+		offsets.append(ends)
+		nsites += len(chunk)
+	outfile.close()
+	site_index = np.concatenate(offsets)[::INDEX_SITES]
+	np.save('%s/acgt_sites.idx.npy' % species.countdir, site_index)
+	return nsites, site_index, first_site
+
+class SparseInput:
+	""" Sorted rows of one sparse SNP file or joined site file, read a chunk at a time """
+	def __init__(self, path, column, chunk_sites, counts=True):
+		self.column = column # column of sample in count matrix of its batch, or number of group
+		columns = ['ref_id', 'ref_pos', 'ref_allele'] + (ALLELE_COUNTS if counts else [])
+		dtype = dict([('ref_id', str), ('ref_pos', np.int64), ('ref_allele', str)] + [(column, np.uint32) for column in ALLELE_COUNTS])
+		self.chunks = read_run_midas_snps(path, columns, dtype, float('Inf'), chunk_sites=chunk_sites)
+		self.positions, self.start, self.counts = np.zeros(0, dtype=np.int64), 0, None
+		self.found = self.next_chunk() # False for a file without sites
+
+	def next_chunk(self):
+		""" Read next chunk of rows; returns False at end of file, which is then closed """
+		for chunk in self.chunks:
+			if len(chunk) > 0:
+				self.ref_ids = chunk['ref_id'].values.astype(object)
+				self.positions = chunk['ref_pos'].values
+				self.alleles = chunk['ref_allele'].values.astype(object)
+				self.counts = chunk[ALLELE_COUNTS].values if ALLELE_COUNTS[0] in chunk else None
+				self.start = 0
+				return True
+		return False
+
+	def close(self):
+		""" Close file and its decompression thread """
+		self.chunks.close()
+
+	def pending(self):
+		""" Return True if rows of current chunk are left """
+		return self.start < len(self.positions)
+
+	def last_key(self):
+		""" (ref_id, ref_pos) of last row in chunk """
+		return (self.ref_ids[-1], int(self.positions[-1]))
+
+	def take(self, key):
+		""" Return (ref_ids, positions, alleles, counts) of pending rows up to and including <key>; counts may be None """
+		ref_id, ref_pos = key
+		ref_ids = self.ref_ids[self.start:]
+		lo = self.start + np.searchsorted(ref_ids, ref_id, side='left')
+		hi = self.start + np.searchsorted(ref_ids, ref_id, side='right')
+		end = lo + np.searchsorted(self.positions[lo:hi], ref_pos, side='right')
+		rows = slice(self.start, end)
+		self.start = end
+		return self.ref_ids[rows], self.positions[rows], self.alleles[rows], self.counts[rows] if self.counts is not None else None
+
+def join_sorted_inputs(inputs, max_sites):
+	""" Streaming k-way join of SparseInputs on (ref_id, ref_pos), keeping the first <max_sites> joined sites
+		A heap orders inputs by the last site of their current chunk, and all rows up to the smallest of these
+		are joined at once. Yields ((ref_ids, positions, alleles) of joined sites, [(input, joined rows, counts)])
+		for each step; rows of each input are in file order and joined rows count from 0 over the whole join.
+		Sites are sorted by ref_id, then ref_pos; the reference allele is taken from the first input """
+	heap = [(input.last_key(), index) for index, input in enumerate(inputs) if input.found]
+	heapq.heapify(heap)
+	nsites = 0
+	while heap and nsites < max_sites:
+		# every site up to the smallest last key has been read from every input
+		key = heap[0][0]
+		pieces = [(input, input.take(key)) for input in inputs if input.pending()]
+		while heap and heap[0][0] <= key:
+			index = heapq.heappop(heap)[1]
+			if inputs[index].next_chunk():
+				heapq.heappush(heap, (inputs[index].last_key(), index))
+		ref_ids = np.concatenate([piece[0] for input, piece in pieces])
+		positions = np.concatenate([piece[1] for input, piece in pieces])
+		alleles = np.concatenate([piece[2] for input, piece in pieces])
+		contigs, contig_codes = np.unique(ref_ids, return_inverse=True)
+		keys = contig_codes.astype(np.int64) * (int(positions.max()) + 1) + positions
+		keys, first, rows = np.unique(keys, return_index=True, return_inverse=True)
+		keep = int(min(len(keys), max_sites - nsites))
+		joined, start = [], 0
+		for input, piece in pieces:
+			piece_rows = rows[start:start+len(piece[1])]
+			start += len(piece[1])
+			kept = piece_rows < keep # rows past max_sites are last in file order
+			joined.append((input, nsites + piece_rows[kept], piece[3][kept] if piece[3] is not None else None))
+		yield (ref_ids[first[:keep]], positions[first[:keep]], alleles[first[:keep]]), joined
+		nsites += keep
+	for input in inputs:
+		input.close()
+
+def join_sparse_sites(species, args):
+	""" Yield DataFrames of ref_id, ref_pos, ref_allele for sites found in any sample
+		Sparse inputs omit sites without reads and are sorted by ref_id, then ref_pos, so each file is read once
+		by streaming k-way joins. At most SPARSE_FANIN files are open at once: samples of each batch are joined
+		in groups into sorted site files, whose sites are then joined across groups. Non-zero counts of each
+		group go to acgt_entries.<split_num>.<part>.bin, and the row of each group site in the count matrices
+		to acgt_entries.<split_num>.<part>.rows.npy, for build_temp_count_matrix """
+	groups = [] # (split_num, part, [(column, sample)])
+	for split_num, samples in enumerate(species.sample_lists):
+		columns = list(enumerate(samples))
+		for part, start in enumerate(range(0, len(columns), SPARSE_FANIN)):
+			groups.append((split_num, part, columns[start:start+SPARSE_FANIN]))
+	chunk_sites = max(1000, CHUNK_SITES // min(len(species.samples), SPARSE_FANIN))
+	# join samples of each group; rows of entries are rows of the group's site file
+	group_sites = []
+	for group, (split_num, part, columns) in enumerate(groups):
+		inputs = [SparseInput(run_midas_snps_path(sample, species.id), column, chunk_sites) for column, sample in columns]
+		path = '%s/sparse_sites.%s.txt' % (species.countdir, group)
+		nsites = 0
+		with open(path, 'w') as site_file, open('%s/acgt_entries.%s.%s.bin' % (species.countdir, split_num, part), 'wb') as entry_file:
+			site_file.write('ref_id\tref_pos\tref_allele\n')
+			for sites, pieces in join_sorted_inputs(inputs, args['max_sites']):
+				site_file.write(merge.format_rows(list(sites), '%s\t%s\t%s\n'))
+				nsites += len(sites[0])
+				for input, rows, counts in pieces:
+					found = counts.sum(axis=1) > 0
+					entries = np.zeros(found.sum(), dtype=SPARSE_ENTRY)
+					entries['row'] = rows[found]
+					entries['column'] = input.column
+					entries['counts'] = counts[found]
+					entry_file.write(entries.tobytes())
+		group_sites.append((path, nsites))
+	# join sites across groups; group_rows maps each group site to its joined site, -1 past max_sites
+	inputs = [SparseInput(path, group, chunk_sites, counts=False) for group, (path, nsites) in enumerate(group_sites)]
+	sites, group_rows = [], [[] for group in groups]
+	for joined, pieces in join_sorted_inputs(inputs, args['max_sites']):
+		sites.append(joined)
+		for input, rows, counts in pieces:
+			group_rows[input.column].append(rows)
+	# select sites in --region or --shard, and save their rows in the count matrices
+	sites = pd.DataFrame({'ref_id': np.concatenate([site[0] for site in sites] + [np.zeros(0, dtype=object)]),
+						  'ref_pos': np.concatenate([site[1] for site in sites] + [np.zeros(0, dtype=np.int64)]).astype(str),
+						  'ref_allele': np.concatenate([site[2] for site in sites] + [np.zeros(0, dtype=object)])})
+	selected = select_sites(sites, args, len(sites))
+	site_rows = np.append(np.where(selected, np.cumsum(selected) - 1, -1), -1)
+	for group, (split_num, part, columns) in enumerate(groups):
+		rows = np.concatenate(group_rows[group] + [np.zeros(0, dtype=np.int64)])
+		rows = np.append(rows, np.full(group_sites[group][1] - len(rows), -1, dtype=np.int64))
+		np.save('%s/acgt_entries.%s.%s.rows.npy' % (species.countdir, split_num, part), site_rows[rows])
+		os.remove(group_sites[group][0])
+	sites = sites[selected]
+	for start in range(0, len(sites), CHUNK_SITES):
+		yield sites.iloc[start:start+CHUNK_SITES]
+
+def build_temp_count_matrix(countdir, species_id, samples, split_num, nsites, sparse=False, first_site=0):
+	""" Build (sites x samples x 4) matrix of ACGT counts using a subset of total samples
+		Sparse samples were joined by join_sparse_sites; their missing sites keep zero counts
+		Also writes (sites x 4) counts pooled across the subset of samples """
+	path = '%s/acgt_counts.%s.npy' % (countdir, split_num)
+	counts = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint32, shape=(nsites, len(samples), 4))
+	if sparse:
+		for part in range(0, len(samples), SPARSE_FANIN):
+			prefix = '%s/acgt_entries.%s.%s' % (countdir, split_num, part // SPARSE_FANIN)
+			fill_sparse_counts(counts, prefix + '.bin', prefix + '.rows.npy')
+		samples = []
+	for index, sample in enumerate(samples):
+		inpath = run_midas_snps_path(sample, species_id)
+		row = 0
+		for chunk in read_run_midas_snps(inpath, ALLELE_COUNTS, np.uint32, nsites, first_site):
+			counts[row:row+len(chunk), index] = chunk[ALLELE_COUNTS].values
+			row += len(chunk)
+		if row != nsites: # dense files must all list the same sites
+			sys.exit("\nError: expected %s sites but found %s in %s\nUse --sparse if samples were run with 'run_midas.py snps --sparse'\n" % (nsites, row, inpath))
+	counts.flush()
+	pooled = np.lib.format.open_memmap('%s/acgt_pooled.%s.npy' % (countdir, split_num), mode='w+', dtype=np.int64, shape=(nsites, 4))
+	for start in range(0, nsites, CHUNK_SITES):
+		pooled[start:start+CHUNK_SITES] = counts[start:start+CHUNK_SITES].sum(axis=1, dtype=np.int64)
+	pooled.flush()
+	del counts, pooled
+
+def fill_sparse_counts(counts, entries_path, rows_path):
+	""" Fill count matrix with entries written by join_sparse_sites, then remove them
+		rows_path: row in the count matrix of each site the entries refer to, -1 if not selected """
+	site_rows = np.load(rows_path)
+	with open(entries_path, 'rb') as infile:
+		while True:
+			entries = np.fromfile(infile, dtype=SPARSE_ENTRY, count=CHUNK_SITES)
+			if len(entries) == 0:
+				break
+			rows = site_rows[entries['row']]
+			found = rows >= 0
+			counts[rows[found], entries['column'][found]] = entries['counts'][found]
+	os.remove(entries_path)
+	os.remove(rows_path)
+
+def count_matrix_jobs(species, args, splits):
+	""" Return arguments to build one count matrix per batch of samples in <splits> """
 	argument_list = []
-	for split_num, sample_ids in enumerate(species.sample_lists):
-		arguments=(species.tempdir, species.id, sample_ids, split_num, args['max_sites'])
+	for split_num in splits:
+		arguments=(species.countdir, species.id, species.sample_lists[split_num], split_num, species.nsites, args['sparse'], species.first_site)
 		argument_list.append(arguments)
-	parallel(build_temp_count_matrix, argument_list, args['threads'])
+	return argument_list
 
-def	read_count_matrixes(species, args):
-	""" Open matrices for reading and skip headers """
-	files = []
+def read_count_matrixes(species, args):
+	""" Open count matrices read-only; each is (sites x samples in split x 4), with (sites x 4) pooled counts """
+	matrices = []
 	for split_num in range(species.num_splits):
-		path = '%s/acgt_counts.%s.txt' % (species.tempdir, split_num)
-		files.append(open(path))
-		next(files[split_num])
-	return files
+		counts = np.load('%s/acgt_counts.%s.npy' % (species.countdir, split_num), mmap_mode='r')
+		pooled = np.load('%s/acgt_pooled.%s.npy' % (species.countdir, split_num), mmap_mode='r')
+		matrices.append((counts, pooled))
+	return matrices
+
+def fetch_count_block(matrices, start, end):
+	""" Fetch (sites x samples x 4) counts across all splits and (sites x 4) pooled counts for sites in [start, end) """
+	counts = np.concatenate([matrix[start:end] for matrix, pooled in matrices], axis=1)
+	pooled = sum(pooled[start:end] for matrix, pooled in matrices)
+	return counts, pooled
+
+def read_count_store(species):
+	""" Return sample ids of each batch in the persistent count store of species; empty if there is none """
+	batches = []
+	path = '%s/samples.txt' % species.countdir
+	if os.path.isfile(path):
+		for r in utility.parse_file(path):
+			split_num = int(r['split_num'])
+			while len(batches) <= split_num:
+				batches.append([])
+			batches[split_num].append(r['sample_id'])
+	return batches
+
+def write_count_store(species):
+	""" Record which samples are stored in each batch of count matrices """
+	outfile = open('%s/samples.txt' % species.countdir, 'w')
+	outfile.write('sample_id\tsplit_num\n')
+	for split_num, samples in enumerate(species.sample_lists):
+		for sample in samples:
+			outfile.write('%s\t%s\n' % (sample.id, split_num))
+	outfile.close()
+
+def read_site_list(species, line_from):
+	""" Yield (site_id, ref_id, ref_pos, ref_allele) for sites starting at <line_from> """
+	infile = open('%s/acgt_sites.txt' % species.countdir, 'rb')
+	infile.seek(int(species.site_index[line_from // INDEX_SITES]))
+	for line_num in range(line_from - line_from % INDEX_SITES, line_from):
+		next(infile)
+	for line in infile:
+		yield line.decode('utf-8').rstrip('\n').split('\t')
+	infile.close()
+
+def table_names(args):
+	""" Return file names of merged tables by type; with --matrix_format binary, snps_matrix.bin holds freq and depth """
+	if args['matrix_format'] == 'binary':
+		return {'info': 'snps_info.txt', 'matrix': 'snps_matrix.bin'}
+	return dict([(ftype, 'snps_%s.txt' % ftype) for ftype in ['info', 'freq', 'depth']])
+
+def shard_table_path(species, name, thread):
+	""" Path to table of one thread, e.g. snps_info.0.txt """
+	root, ext = os.path.splitext(name)
+	return '%s/%s.%s%s' % (species.tempdir, root, thread, ext)
 
 def write_merge_midas(species, args, thread=None):
 	""" Open output files for species """
 	files = {}
-	# open files
-	for ftype in ['info', 'freq', 'depth']:
+	# open files; shards have no headers so they can be concatenated as-is
+	sample_ids = [s.id for s in species.samples] if thread is None else None
+	for ftype, name in table_names(args).items():
 		if thread is None:
-			path = '%s/%s/snps_%s.txt' % (args['outdir'], species.id, ftype)
+			path = '%s/%s' % (species.outdir, name)
 		else:
-			path = '%s/%s/temp/snps_%s.%s.txt' % (args['outdir'], species.id, ftype, thread)
-		files[ftype] = open(path, 'w')
+			path = shard_table_path(species, name, thread)
+		files[ftype] = snps_matrix.MatrixWriter(path, sample_ids) if ftype == 'matrix' else open(path, 'w')
 	# write headers
+	if thread is not None:
+		return files
 	for ftype in ['freq', 'depth']:
-		record = ['site_id']+[s.id for s in species.samples]
-		files[ftype].write('\t'.join(record)+'\n')
+		if ftype in files:
+			files[ftype].write('\t'.join(['site_id']+sample_ids)+'\n')
 	info_fields = ['site_id', 
 				   'ref_id', 
 				   'ref_pos',
@@ -302,97 +508,101 @@ def write_merge_midas(species, args, thread=None):
 	return files
 
 def build_sharded_tables(species, args, thread, line_from, line_to, errcnt=multiprocessing.Value('i', 0)):
-	""" Build merged output files for species using every <thread>th site"""
-	infiles = read_count_matrixes(species, args)
+	""" Build merged output files for species using sites in [line_from, line_to) """
+	matrices = read_count_matrixes(species, args)
+	sites = read_site_list(species, line_from)
 	outfiles = write_merge_midas(species, args, thread)
 	try:
-		genes = utility.read_genes(species.id, args['iggdb'])
-	except:
-		genes = None
+		annotations = annotation.read_site_annotations(species.id, args['iggdb'])
+	except (IOError, OSError): # no annotation file; see 'smelter annotate_repgenomes'
+		annotations = None
 		with errcnt.get_lock():
 			errcnt.value += 1
 			if errcnt.value == 1:
 				traceback.print_exc()
 				tserr("Apologies - gene annotations disabled in this run.")
 	
-	line_num = -1
-	while True:
-				
-		# fetch allele counts for next site
-		try:
-			lines = [next(file) for file in infiles]
-		except StopIteration:
-			break
+	block_sites = max(1, BLOCK_CELLS // len(species.samples))
+	for block_from in range(line_from, line_to, block_sites):
 		
-		# control which lines are processed
-		line_num += 1
-		if line_num < line_from:
-			continue
-		elif line_num >= line_to:
-			break
+		# fetch allele counts for next block of sites
+		block_to = min(block_from + block_sites, line_to)
+		counts, pooled = fetch_count_block(matrices, block_from, block_to)
 		
-		# initialize GenomicSite
-		values = sum([line.rstrip().split()[1:] for line in lines], [lines[0].split()[0]])
-		site_id = line_num+1
-		site = GenomicSite(site_id, values)
-		site.call_alleles(args['allele_freq'])
-		site.compute_per_sample_mafs()
-		site.compute_prevalence(species.sample_depth, args['site_depth'], args['site_ratio'])
-		site.flag(args['site_prev'], args['snp_type'])
+		# call alleles for all sites in block at once
+		block = SiteBlock([next(sites) for _ in range(block_to - block_from)], counts, pooled)
+		block.call_alleles(args['allele_freq'])
+		block.compute_per_sample_mafs()
+		block.compute_prevalence(species.sample_depth, args['site_depth'], args['site_ratio'])
+		block.flag(args['site_prev'], args['snp_type'])
 		
-		# decide what to do with site
-		if site.flag[0] is True:
-			continue
-		if genes:
-			site.annotate(genes)
-		site.write(outfiles)
+		# annotate and write sites that pass filters
+		if annotations is not None:
+			block.annotate(annotations)
+		block.write(outfiles)
 	
 	# finish up
-	for file in infiles: file.close()
+	sites.close()
 	for file in outfiles.values(): file.close()
 
-def parallel_build_sharded_tables(species, args):
-	""" """
-	# get number of total lines to process
-	infiles = read_count_matrixes(species, args)
-	num_lines = 0
-	for line in infiles[0]:
-		num_lines += 1
-	for file in infiles:
-		file.close()
-
-	lines_per = max(1, num_lines/args['threads'])
-	line_ranges = [[thread * lines_per, thread * lines_per + lines_per] for thread in range(args['threads'])]
-	line_ranges[-1][-1] = num_lines
-
-	argument_list = []
-	for thread, line_range in enumerate(line_ranges):
-		line_from, line_to = line_range
-		arguments=(species, args, thread, line_from, line_to)
-		argument_list.append(arguments)
-	
-	parallel(build_sharded_tables, argument_list, args['threads'])
+def shard_line_ranges(species, args):
+	""" Split sites into one non-empty contiguous range per thread, with at most one shard per site
+		A species without sites gets a single empty shard, so its output tables are still written """
+	num_lines = species.nsites
+	if num_lines == 0:
+		return [[0, 0]]
+	num_shards = min(args['threads'], num_lines)
+	return [[thread * num_lines // num_shards, (thread + 1) * num_lines // num_shards] for thread in range(num_shards)]
+
+def copy_file(infile, outfile):
+	""" Append contents of <infile> to <outfile> without copying through Python when possible
+		Both files are unbuffered, so the kernel file positions are the only ones """
+	size = os.fstat(infile.fileno()).st_size - infile.tell()
+	copied = 0
+	try:
+		while copied < size:
+			if hasattr(os, 'copy_file_range'):
+				n = os.copy_file_range(infile.fileno(), outfile.fileno(), size - copied)
+			else:
+				n = os.sendfile(outfile.fileno(), infile.fileno(), None, size - copied)
+			if n == 0: break
+			copied += n
+	except OSError: # e.g. unsupported by file system
+		shutil.copyfileobj(infile, outfile)
+
+def concatenate_tables(inpaths, outpath, skip_header=False):
+	""" Append tables in <inpaths> to <outpath>, optionally without their header lines """
+	outfile = open(outpath, 'r+b', buffering=0)
+	outfile.seek(0, os.SEEK_END)
+	for inpath in inpaths:
+		with open(inpath, 'rb', buffering=0) as infile:
+			if skip_header and inpath.endswith('.bin'):
+				snps_matrix.read_header(infile)
+			elif skip_header:
+				infile.readline()
+			copy_file(infile, outfile)
+	outfile.close()
 
 def merge_sharded_tables(species, args):
-	""" Merge N sets of sharded tables, where N is the number of threads"""
-	# open output tables
+	""" Merge N sets of sharded tables, where N is the number of shards from shard_line_ranges
+		Tables are assembled concurrently at the byte level """
+	from concurrent.futures import ThreadPoolExecutor
 	outfiles = write_merge_midas(species, args)
-	# open input sharded tables
-	infiles = {}
-	for thread in range(args['threads']):
-		infiles[thread] = {}
-		for ftype in ['freq', 'depth', 'info']:
-			path = '%s/%s/temp/snps_%s.%s.txt' % (args['outdir'], species.id, ftype, thread)
-			infiles[thread][ftype] = open(path)
-	# skip headers
-	for thread in range(args['threads']):
-		for ftype in ['freq', 'depth', 'info']:
-			next(infiles[thread][ftype])
-	# write remainder of lines
-	for thread in range(args['threads']):
-		for ftype in ['freq', 'depth', 'info']:
-			for line in infiles[thread][ftype]:
-				outfiles[ftype].write(line)
+	for file in outfiles.values(): file.close()
+	with ThreadPoolExecutor(len(outfiles)) as pool:
+		futures = []
+		for ftype, name in table_names(args).items():
+			inpaths = [shard_table_path(species, name, thread) for thread in range(species.num_shards)]
+			futures.append(pool.submit(concatenate_tables, inpaths, outfiles[ftype].name))
+		for future in futures:
+			future.result()
+
+def index_tables(species, args):
+	""" Write block index of snps_matrix.bin and site index of merged tables, for random access by parse_snps """
+	tables = table_names(args)
+	if 'matrix' in tables:
+		snps_matrix.write_index('%s/%s' % (species.outdir, tables['matrix']))
+	snps_matrix.write_site_index(species.outdir, dict([(ftype, name) for ftype, name in tables.items() if ftype != 'matrix']))
 
 def write_snps_readme(args, sp):
 	outfile = open('%s/%s/readme.txt' % (args['outdir'], sp.id), 'w')
@@ -409,6 +619,12 @@ snps_freq.txt
 snps_depth.txt
   number of reads mapped to genomic site per sample
   only accounts for reads matching either major or minor allele
+snps_matrix.bin
+  written instead of snps_freq.txt and snps_depth.txt with --matrix_format binary
+  compressed blocks of sites holding both matrices; read with midas.analyze.parse_snps
+  stores minor allele counts and depths, from which frequencies are computed
+snps_index.npz
+  index of site_ids, positions and byte offsets of rows; used to read a subset of sites without a full scan
 snps_info.txt  
   metadata for genomic site
   see below for more information
@@ -457,48 +673,168 @@ Additional information for species can be found in the reference database:
 	outfile.close()
 
 
-def per_species_work(index):
-	global species_list
-	global global_args
-	args = global_args
-	species = species_list[index]
-	print("  %s" % species.id)
-	species.tempdir = '%s/%s/temp' % (args['outdir'], species.id)
-	if not os.path.isdir(species.tempdir): os.mkdir(species.tempdir)
-	species.sample_lists = utility.batch_samples(species.samples, threads=args['threads'])
-	species.num_splits = len(species.sample_lists)
-	
-	print("    merging count data")
-	parallel_build_temp_count_matrixes(species, args)
-
-	print("    calling SNPs")
-	parallel_build_sharded_tables(species, args)
-
-	# this is the slow step, and it is single-threaded
-	# that is why we have to run this function in multiprocessing,
-	# despite the fact the other steps above are "parallel"
-	print("    writing output files")
+def finish_species(species, args):
+	""" Merge sharded tables, index them, write readme and sample info, and remove temp files; a count store is kept
+		Outputs for --region or --shard get a manifest instead, for 'merge_midas.py snps --finalize' """
 	merge_sharded_tables(species, args)
+	if shard_name(args):
+		write_manifest(species, args)
+	else:
+		index_tables(species, args)
+		write_snps_readme(args, species)
+		species.write_sample_info(dtype='snps', outdir=args['outdir'])
+	shutil.rmtree(species.tempdir)
 
-	print("    finishing")
+def write_manifest(species, args):
+	""" Describe outputs for one --region or --shard of species """
+	import json
+	manifest = {'species_id': species.id,
+				'region': args['region'],
+				'shard': args['shard'],
+				'first_site': species.first_site + 1 if species.nsites > 0 else None,
+				'last_site': species.first_site + species.nsites if species.nsites > 0 else None,
+				'count_sites': species.nsites,
+				'samples': [sample.id for sample in species.samples],
+				'tables': table_names(args)
+				}
+	with open('%s/manifest.json' % species.outdir, 'w') as outfile:
+		json.dump(manifest, outfile, indent=1)
+
+def read_manifests(species, args):
+	""" Read manifests of --region or --shard outputs for species; exit if they cannot be stitched together """
+	import json, glob
+	manifests = []
+	for path in glob.glob('%s/%s/shards/*/manifest.json' % (args['outdir'], species.id)):
+		manifest = json.load(open(path))
+		manifest['dir'] = os.path.dirname(path)
+		manifests.append(manifest)
+	if not manifests:
+		sys.exit("\nError: no outputs from --region or --shard found for %s\n" % species.id)
+	error = "\nError: cannot finalize %s: %s\n"
+	if any(manifest['samples'] != manifests[0]['samples'] for manifest in manifests):
+		sys.exit(error % (species.id, "shards were merged with different samples"))
+	if any(sorted(manifest['tables']) != sorted(table_names(args)) for manifest in manifests):
+		sys.exit(error % (species.id, "shards were merged with a different --matrix_format"))
+	shards = [manifest['shard'] for manifest in manifests if manifest['shard']]
+	if shards:
+		count = parse_shard(shards[0])[1]
+		if len(shards) != len(manifests) or sorted(parse_shard(shard) for shard in shards) != [(i, count) for i in range(1, count+1)]:
+			sys.exit(error % (species.id, "expected shards 1/%s to %s/%s but found: %s" % (count, count, count, ','.join(sorted(shards)))))
+	manifests = sorted([manifest for manifest in manifests if manifest['count_sites'] > 0], key=lambda manifest: manifest['first_site'])
+	for previous, manifest in zip(manifests[:-1], manifests[1:]):
+		if manifest['first_site'] <= previous['last_site']:
+			sys.exit(error % (species.id, "overlapping sites in %s and %s" % (previous['dir'], manifest['dir'])))
+	return manifests
+
+def finalize_species(species, args):
+	""" Stitch together outputs of each --region or --shard of species, in order of site_id """
+	manifests = read_manifests(species, args)
+	samples = dict([(sample.id, sample) for sample in species.samples])
+	missing = [sample_id for sample_id in manifests[0]['samples'] if sample_id not in samples] if manifests else []
+	if missing:
+		sys.exit("\nError: samples merged in shards of %s were not selected: %s\n" % (species.id, ','.join(missing[:5])))
+	if manifests:
+		species.samples = [samples[sample_id] for sample_id in manifests[0]['samples']]
+	species.outdir = '%s/%s' % (args['outdir'], species.id)
+	outfiles = write_merge_midas(species, args)
+	for file in outfiles.values(): file.close()
+	for ftype in outfiles:
+		inpaths = ['%s/%s' % (manifest['dir'], manifest['tables'][ftype]) for manifest in manifests]
+		concatenate_tables(inpaths, outfiles[ftype].name, skip_header=True)
+	index_tables(species, args)
 	write_snps_readme(args, species)
 	species.write_sample_info(dtype='snps', outdir=args['outdir'])
-	shutil.rmtree(species.tempdir)
-
 
-def psw_safe(index, sem):
-	try:
-		per_species_work(index)
-	finally:
-		sem.release()
+def open_count_store(species, args):
+	""" Add samples to batches already in the persistent count store; return numbers of batches to build
+		Output columns list stored samples first, in their stored order, then new samples """
+	samples = dict([(sample.id, sample) for sample in species.samples])
+	stored = read_count_store(species)
+	missing = [sample_id for batch in stored for sample_id in batch if sample_id not in samples]
+	if missing:
+		sys.exit("\nError: %s samples in count store of %s were not selected: %s\nRemove %s to rebuild it\n" % (
+			len(missing), species.id, ','.join(missing[:5]), species.countdir))
+	stored_ids = set([sample_id for batch in stored for sample_id in batch])
+	new_samples = [sample for sample in species.samples if sample.id not in stored_ids]
+	species.sample_lists = [[samples[sample_id] for sample_id in batch] for batch in stored]
+	if new_samples:
+		species.sample_lists += utility.batch_samples(new_samples, threads=args['threads'])
+	species.num_splits = len(species.sample_lists)
+	species.samples = [sample for batch in species.sample_lists for sample in batch]
+	species.fetch_sample_depth()
+	print("  %s: %s stored samples, %s new samples" % (species.id, len(stored_ids), len(new_samples)))
+	return list(range(len(stored), species.num_splits))
+
+def schedule_species(scheduler, species, args):
+	""" Queue jobs to merge species; each phase queues the next one when all of its jobs are done
+		phases: list sites, build count matrices (one job per batch of samples), call SNPs (one job per shard), finish
+		Jobs of species with more input data run first, so the largest species do not start last
+		With --incremental, count matrices are kept in a store and only batches of new samples are built """
+	species.outdir = '%s/%s' % (args['outdir'], species.id)
+	if shard_name(args):
+		species.outdir += '/shards/%s' % shard_name(args)
+	species.tempdir = '%s/temp' % species.outdir
+	species.countdir = '%s/counts' % species.outdir if args['incremental'] else species.tempdir
+	for dir in [species.tempdir, species.countdir]:
+		if not os.path.isdir(dir): os.makedirs(dir)
+	priority = -sum(os.path.getsize(run_midas_snps_path(sample, species.id)) for sample in species.samples)
+	pending = {}
+
+	def sites_done(result):
+		species.nsites, species.site_index, species.first_site = result
+		build_count_matrices(list(range(species.num_splits)))
+
+	def build_count_matrices(splits):
+		print("  %s: merging count data" % species.id)
+		pending['count matrices'] = len(splits)
+		for arguments in count_matrix_jobs(species, args, splits):
+			scheduler.add(build_temp_count_matrix, arguments, priority, files=2, callback=count_matrix_done)
+		if not splits:
+			call_snps()
+
+	def count_matrix_done(result):
+		pending['count matrices'] -= 1
+		if pending['count matrices'] == 0:
+			call_snps()
+
+	def call_snps():
+		if args['incremental']:
+			write_count_store(species)
+		print("  %s: calling SNPs" % species.id)
+		line_ranges = shard_line_ranges(species, args)
+		species.num_shards = len(line_ranges)
+		pending['shards'] = len(line_ranges)
+		for thread, (line_from, line_to) in enumerate(line_ranges):
+			arguments = (species, args, thread, line_from, line_to)
+			scheduler.add(build_sharded_tables, arguments, priority, files=2*species.num_splits+4, callback=shard_done)
+
+	def shard_done(result):
+		pending['shards'] -= 1
+		if pending['shards'] == 0:
+			print("  %s: writing output files" % species.id)
+			scheduler.add(finish_species, (species, args), priority, files=6, callback=species_done)
+
+	def species_done(result):
+		print("  %s: done" % species.id)
+
+	if args['incremental'] and read_count_store(species):
+		splits = open_count_store(species, args)
+		species.nsites = np.load('%s/acgt_counts.0.npy' % species.countdir, mmap_mode='r').shape[0]
+		species.site_index = np.load('%s/acgt_sites.idx.npy' % species.countdir)
+		with open('%s/acgt_sites.txt' % species.countdir) as infile:
+			species.first_site = int(infile.readline().split('\t')[0]) - 1 if species.nsites > 0 else 0
+		build_count_matrices(splits)
+	else:
+		species.sample_lists = utility.batch_samples(species.samples, threads=args['threads'])
+		species.num_splits = len(species.sample_lists)
+		files = min(len(species.samples), SPARSE_FANIN) + 3 if args['sparse'] else 2
+		scheduler.add(write_site_list, (species, args), priority, files=files, callback=sites_done)
 
-	
 def run_pipeline(args):
 	
 	print("Identifying species and samples")
 	if 'db' in args:
 		args['iggdb'] = IGGdb(f"{args['db']}/metadata/species_info.tsv")
-	global species_list
 	species_list = merge.select_species(args, dtype='snps')
 	for species in species_list:
 		print("  %s" % species.id)
@@ -512,14 +848,11 @@ def run_pipeline(args):
 	
 	print("\nMerging snps")
 	
-	global global_args
-	global_args = args
-	sem = multiprocessing.Semaphore(int(args['threads']))
-	procs = []
-	for index in range(0, len(species_list)):
-		sem.acquire()
-		procs.append(multiprocessing.Process(target=psw_safe, args=[index, sem]))
-		procs[-1].start()
-	for p in procs:
-		p.join()
-
+	# one pool of workers runs every phase of every species
+	scheduler = utility.Scheduler(args['threads'])
+	for species in species_list:
+		if args['finalize']:
+			scheduler.add(finalize_species, (species, args), files=6)
+		else:
+			schedule_species(scheduler, species, args)
+	scheduler.run()
@@ -4,8 +4,14 @@
 # Copyright (C) 2015 Stephen Nayfach
 # Freely distributed under the GNU General Public License (GPLv3)
 
-import os, sys, numpy as np
+import os, sys, numpy as np, pandas as pd
 from midas.run import species
+from midas.merge import merge
+
+FIELDS = ['relative_abundance', 'coverage', 'count_reads']
+# columns of species profiles; old field names are used instead if present
+PROFILE_COLUMNS = [('count_reads', 'total_mapped_reads'), ('coverage', 'avg_read_depth'), ('relative_abundance', 'species_abund')]
+BLOCK_CELLS = 1000000 # species x samples formatted at once when writing matrices
 
 class Sample:
 	""" Base class for samples """
@@ -25,67 +31,68 @@ def init_samples(indirs):
 			samples.append(Sample(sample_dir))
 	return samples
 
-def store_data(args, samples, species_ids):
-	data = {}
-	for species_id in species_ids:
-		data[species_id] = {}
-		for field in ['relative_abundance', 'coverage', 'count_reads']:
-			data[species_id][field] = []
-	for sample in samples:
-		abundance = species.read_abundance(sample.path)
-		for species_id, values in abundance.items():
-			for field in ['relative_abundance', 'coverage', 'count_reads']:
-				if field in values: # temporary fix
-					data[species_id][field].append(values[field])
-	return data
+def read_profile(inpath):
+	""" Read species profile of one sample into a DataFrame indexed by species_id """
+	profile = pd.read_csv(inpath, sep='\t', dtype={'species_id':str}, float_precision='round_trip')
+	for column, old_column in PROFILE_COLUMNS:
+		if old_column in profile:
+			profile[column] = profile[old_column] # fix old fields if present
+		elif column not in profile:
+			profile[column] = 0
+	return profile.drop_duplicates('species_id', keep='last').set_index('species_id')
 
-def prevalence(x, y):
-	return(sum([1 if _ >= y else 0 for _ in x]))
+def store_data(args, samples, species_info):
+	""" Read species profiles concurrently into (species x samples) arrays of each field
+		Rows are species found in any sample, in database order; a species missing from a sample is 0 """
+	from concurrent.futures import ThreadPoolExecutor
+	with ThreadPoolExecutor(max(1, args['threads'])) as pool:
+		profiles = list(pool.map(lambda sample: read_profile(sample.path), samples))
+	found = set()
+	for profile in profiles:
+		found.update(profile.index)
+	data = {'species_ids': np.array([species_id for species_id in species_info if species_id in found], dtype=object)}
+	for field in FIELDS:
+		data[field] = np.zeros((len(data['species_ids']), len(samples)), dtype=np.int64 if field == 'count_reads' else float)
+	species_index = pd.Index(data['species_ids'])
+	for column, profile in enumerate(profiles):
+		rows = species_index.get_indexer(profile.index)
+		found = rows >= 0 # species not in database are skipped
+		for field in FIELDS:
+			data[field][rows[found], column] = profile[field].values[found]
+	return data
 
 def compute_stats(args, data):
-	species_ids = data.keys()
-	stats = dict([(s,{}) for s in species_ids])
-	for species_id in species_ids:
-		# abundance
-		x = data[species_id]['relative_abundance']
-		stats[species_id]['median_abundance'] = np.median(x)
-		stats[species_id]['mean_abundance'] = np.mean(x)
-		# coverage
-		x = data[species_id]['coverage']
-		stats[species_id]['median_coverage'] = np.median(x)
-		stats[species_id]['mean_coverage'] = np.mean(x)
-		# prevalence
-		stats[species_id]['prevalence'] = prevalence(x, y=args['min_cov'])
+	""" Compute summary stats of each species across samples """
+	stats = {}
+	stats['median_abundance'] = np.median(data['relative_abundance'], axis=1)
+	stats['mean_abundance'] = np.mean(data['relative_abundance'], axis=1)
+	stats['median_coverage'] = np.median(data['coverage'], axis=1)
+	stats['mean_coverage'] = np.mean(data['coverage'], axis=1)
+	stats['prevalence'] = (data['coverage'] >= args['min_cov']).sum(axis=1)
 	return stats
 
+def write_matrix(outpath, row_ids, column_ids, matrix):
+	""" Write tab-delimited matrix in blocks of rows """
+	with open(outpath, 'w') as outfile:
+		outfile.write('\t'.join(['species_id']+list(column_ids))+'\n')
+		fmt = '%s' + '\t%s' * matrix.shape[1] + '\n'
+		block_rows = max(1, BLOCK_CELLS // max(1, matrix.shape[1]))
+		for start in range(0, len(row_ids), block_rows):
+			block = matrix[start:start+block_rows]
+			outfile.write(merge.format_rows([row_ids[start:start+block_rows]] + list(block.T), fmt))
+
 def write_abundance(args, samples, data):
-	for field in ['relative_abundance', 'coverage', 'count_reads']:
-		outfile = open('%s/%s.txt' % (args['outdir'], field), 'w')
-		outfile.write('\t'.join(['species_id']+[s.id for s in samples])+'\n')
-		for species_id in data:
-			outfile.write(species_id)
-			for x in data[species_id][field]:
-				outfile.write('\t%s' % str(x))
-			outfile.write('\n')
-
-def write_stats(args, stats):
-	# open output file
-	outfile = open('%s/species_prevalence.txt' % args['outdir'], 'w')
+	for field in FIELDS:
+		write_matrix('%s/%s.txt' % (args['outdir'], field), data['species_ids'], [s.id for s in samples], data[field])
+
+def write_stats(args, data, stats):
 	fields = ['mean_coverage', 'median_coverage', 'mean_abundance', 'median_abundance', 'prevalence']
-	header = ['species_id']+fields
-	outfile.write('\t'.join(header)+'\n')
-	# order species ids by decreasing abundance
-	sorted_species = [[x, y['prevalence']] for x, y in stats.items()]
-	sorted_species.sort(key=lambda x: x[1], reverse=True)
-	# write stats
-	for species_id, prevalence in sorted_species:
-		outfile.write(species_id)
-		for field in fields:
-			if field == 'prevalence':
-				outfile.write('\t%s' % str(stats[species_id][field]))
-			else:
-				outfile.write('\t%s' % str(round(stats[species_id][field], 2)))
-		outfile.write('\n')
+	# order species ids by decreasing prevalence
+	order = np.argsort(-stats['prevalence'], kind='stable')
+	table = np.empty((len(order), len(fields)), dtype=object)
+	for index, field in enumerate(fields):
+		table[:, index] = (stats[field] if field == 'prevalence' else np.round(stats[field], 2))[order]
+	write_matrix('%s/species_prevalence.txt' % args['outdir'], data['species_ids'][order], fields, table)
 
 def identify_samples(args):
 	samples = []
@@ -147,7 +154,7 @@ def run_pipeline(args):
 	stats = compute_stats(args, data)
 	# write results
 	write_abundance(args, samples, data)
-	write_stats(args, stats)
+	write_stats(args, data, stats)
 	# write readme
 	write_readme(args)
 	
\ No newline at end of file
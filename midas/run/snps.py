@@ -254,9 +254,8 @@ def pysam_pileup(args, species, contigs):
 	
 	tsprint("Read contigs")
 
-	mp = multiprocessing.Pool(int(args['threads']))
 	# update alignment stats for species objects
-	for species_id, stats in mp.starmap(species_pileup, argument_list):
+	for species_id, stats in utility.parallel(species_pileup, argument_list, args['threads']):
 		sp = species[species_id]
 		sp.genome_length = int(stats['genome_length'])
 		sp.covered_bases = int(stats['covered_bases'])
@@ -4,11 +4,14 @@
 # Copyright (C) 2015 Stephen Nayfach
 # Freely distributed under the GNU General Public License (GPLv3)
 
-import sys, argparse
+import sys, argparse, threading, itertools, queue
 from midas import utility
 
+BLOCK_SIZE = 4 * 1024 * 1024 # bytes of decompressed input parsed at once
+QUEUE_SIZE = 4 # number of decompressed blocks buffered ahead of the parser
+
 def readfq(fp):
-	""" https://github.com/lh3/readfq/blob/master/readfq.py 
+	""" https://github.com/lh3/readfq/blob/master/readfq.py
 		A generator function for parsing fasta/fastq records """
 	last = None # this is a buffer keeping the last unprocessed line
 	while True: # mimic closure; is it a bad idea?
@@ -40,28 +43,143 @@ def readfq(fp):
 				yield name, seq, None # yield a fasta record instead
 				break
 
+def decompress_blocks(inpath, blocks, stop):
+	""" Read decompressed blocks of <inpath> into queue; runs on a separate thread """
+	try:
+		infile = utility.iopen(inpath, 'rb')
+		while not stop.is_set():
+			block = infile.read(BLOCK_SIZE)
+			if not block: break
+			blocks.put(block)
+		infile.close()
+		blocks.put(None)
+	except Exception as e:
+		blocks.put(e)
+
+def read_blocks(inpath):
+	""" Yield blocks of bytes from <inpath>, decompressing ahead of the caller """
+	blocks = queue.Queue(QUEUE_SIZE)
+	stop = threading.Event()
+	reader = threading.Thread(target=decompress_blocks, args=(inpath, blocks, stop))
+	reader.daemon = True # don't wait on reader if we stop early (-n)
+	reader.start()
+	try:
+		while True:
+			block = blocks.get()
+			if block is None: break
+			elif isinstance(block, Exception): raise block
+			yield block
+	finally:
+		stop.set()
+		while not blocks.empty(): # unblock reader if it is waiting on a full queue
+			blocks.get()
+
+def parse_fastq_blocks(blocks):
+	""" Yield lists of (header, seq) from blocks of fastq records
+		4-line records are split with bytes operations; from the first block with
+		records spanning more lines, the rest of the file is parsed with readfq """
+	carry = b''
+	for block in blocks:
+		data = carry + block
+		if b'\r' in data: # CRLF line endings
+			data = data.replace(b'\r', b'')
+		lines = data.split(b'\n')
+		used = 4 * ((len(lines) - 1) // 4) # complete records; last line may be partial
+		if irregular_fastq(lines[:used]):
+			for records in parse_readfq(itertools.chain([data], blocks)):
+				yield records
+			return
+		yield list(zip([line[1:] for line in lines[0:used:4]], lines[1:used:4]))
+		carry = b'\n'.join(lines[used:])
+	lines = carry.replace(b'\r', b'').split(b'\n')
+	if irregular_fastq(lines[:4 * (len(lines) // 4)]):
+		for records in parse_readfq([carry]):
+			yield records
+		return
+	used = 4 * (len(lines) // 4)
+	yield list(zip([line[1:] for line in lines[0:used:4]], lines[1:used:4]))
+
+def parse_fasta_blocks(blocks):
+	""" Yield lists of (header, seq) from blocks of (multi-line) fasta records """
+	carry = b''
+	for block in blocks:
+		data = carry + block
+		end = data.rfind(b'\n>') # start of last, possibly incomplete, record
+		if end == -1:
+			carry = data
+			continue
+		carry = data[end+1:]
+		yield parse_fasta_records(data[:end])
+	if carry:
+		yield parse_fasta_records(carry)
+
+def parse_fasta_records(data):
+	""" Split bytes containing complete fasta records into (header, seq) """
+	if b'\r' in data: # CRLF line endings
+		data = data.replace(b'\r', b'')
+	records = []
+	for record in data.lstrip(b'>').split(b'\n>'):
+		header, _, seq = record.partition(b'\n')
+		records.append((header, seq.replace(b'\n', b'')))
+	return records
+
+def irregular_fastq(lines):
+	""" Check if fastq records in complete <lines> span more than 4 lines; these are parsed with readfq """
+	return any(line[:1] != b'+' for line in lines[2::4])
+
+def parse_blocks(inpath):
+	""" Yield lists of (header, seq) for blocks of records in <inpath> """
+	file_type = utility.auto_detect_file_type(inpath)
+	blocks = read_blocks(inpath)
+	if file_type == 'fasta':
+		return parse_fasta_blocks(blocks)
+	else:
+		return parse_fastq_blocks(blocks)
+
+def split_lines(blocks):
+	""" Yield lines of text, ending in a newline, from blocks of bytes """
+	carry = b''
+	for block in blocks:
+		lines = (carry + block).split(b'\n')
+		carry = lines.pop()
+		for line in lines:
+			yield line.rstrip(b'\r').decode() + '\n'
+	if carry.rstrip(b'\r'):
+		yield carry.rstrip(b'\r').decode() + '\n'
+
+def parse_readfq(blocks):
+	""" Yield single-record lists using readfq; fallback for multi-line fastq """
+	for name, seq, qual in readfq(split_lines(blocks)):
+		yield [(name.encode(), seq.encode())]
+
 def main():
 	""" Run main pipeline """
 	args = parse_args()
 	reads = 0
 	bp = 0
+	stdout = sys.stdout.buffer
 	for inpath in args['input']:
-		infile = utility.iopen(inpath)
-		for name, seq, qual in readfq(infile):
-			id = name.split()[0]
-			seq_len = len(seq)
-			if args['read_length']: # trim/filter reads
-				if seq_len < args['read_length']:
-					continue
-				else:
-					seq = seq[0:args['read_length']]
-					seq_len = len(seq)
-			sys.stdout.write('>%s_%s\n%s\n' % (id, seq_len, seq))
-			reads += 1
-			bp += seq_len
+		for records in parse_blocks(inpath):
+			batch = []
+			for header, seq in records:
+				id = header.split(None, 1)[0] if header else header
+				if args['read_length']: # trim/filter reads
+					if len(seq) < args['read_length']:
+						continue
+					else:
+						seq = seq[0:args['read_length']]
+				seq_len = len(seq)
+				batch.append(b'>%s_%d\n%s\n' % (id, seq_len, seq))
+				reads += 1
+				bp += seq_len
+				if reads == args['max_reads']:
+					break
+			stdout.write(b''.join(batch)) # write batch of reads in one call
 			if reads == args['max_reads']:
+				stdout.flush()
 				sys.stderr.write('%s\t%s' % (reads, bp)) # write number of reads, bp to stderr
 				return
+	stdout.flush()
 	sys.stderr.write('%s\t%s' % (reads, bp)) # write number of reads, bp to stderr
 
 def parse_args():
@@ -77,6 +195,3 @@ def parse_args():
 
 if __name__ == "__main__":
 	main()
-
-
-
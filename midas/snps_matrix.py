@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+
+# MIDAS: Metagenomic Intra-species Diversity Analysis System
+# Copyright (C) 2015 Stephen Nayfach
+# Freely distributed under the GNU General Public License (GPLv3)
+
+import io, os, zlib, struct, numpy as np, pandas as pd
+
+# Binary store for the snps_freq and snps_depth matrices of 'merge_midas.py snps' (snps_matrix.bin)
+# The file is a header followed by independent blocks of consecutive sites:
+#   header: MAGIC, length of sample list, tab-separated sample ids
+#   block:  BLOCK_MAGIC, number of sites, number of samples, bytes per count,
+#           compressed size of each segment, then the zlib-compressed segments:
+#           site ids (int64), minor allele count of each sample, depth of each sample (uint16, or uint32 if needed)
+# Frequencies are minor allele count / depth, so they are stored without loss of precision.
+# Each sample's column is a separate segment, so a subset of samples can be read without decompressing the others.
+# Headerless files of blocks can be concatenated as-is, like the sharded text tables.
+# The block index (snps_matrix.bin.idx.npy) holds the byte offset, first site id and number of sites of each block.
+#
+# Site index of merged tables (snps_index.npz), for reading sites by site_id or region without a full scan
+#   site_ids, ref_pos: of each row of snps_info.txt
+#   contigs, contig_rows: ref_id of each run of rows on one contig and the first row of each run (plus number of rows)
+#   offsets_<type>: byte offset of every INDEX_ROWS-th row of each text table, e.g. offsets_info
+MAGIC = b'MIDASMTX'
+BLOCK_MAGIC = b'BLK1'
+BLOCK_HEADER = struct.Struct('<4sIIB')
+LEVEL = 6
+INDEX_ROWS = 10000 # rows between byte offsets in site index
+READ_SIZE = 16 * 1024 * 1024 # bytes scanned at once for row offsets
+
+def write_header(outfile, sample_ids):
+	samples = '\t'.join(sample_ids).encode('utf-8')
+	outfile.write(MAGIC + struct.pack('<I', len(samples)) + samples)
+
+def read_header(infile):
+	""" Read header; return list of sample ids """
+	magic = infile.read(len(MAGIC))
+	if magic != MAGIC:
+		raise IOError("Not a MIDAS SNP matrix file: %s" % infile.name)
+	size = struct.unpack('<I', infile.read(4))[0]
+	samples = infile.read(size).decode('utf-8')
+	return samples.split('\t') if samples else []
+
+def count_dtype(count_bytes):
+	return np.uint16 if count_bytes == 2 else np.uint32
+
+def encode_block(site_ids, minor_counts, depths):
+	""" Encode sites x samples arrays of minor allele counts and depths as one block """
+	count_bytes = 2 if depths.size == 0 or depths.max() <= np.iinfo(np.uint16).max else 4
+	segments = [np.asarray(site_ids, dtype=np.int64).tobytes()]
+	for counts in [minor_counts, depths]:
+		segments += [np.ascontiguousarray(column, dtype=count_dtype(count_bytes)).tobytes() for column in counts.T]
+	segments = [zlib.compress(segment, LEVEL) for segment in segments]
+	sizes = np.array([len(segment) for segment in segments], dtype=np.uint32)
+	header = BLOCK_HEADER.pack(BLOCK_MAGIC, len(site_ids), depths.shape[1], count_bytes)
+	return b''.join([header, sizes.tobytes()] + segments)
+
+class MatrixWriter:
+	""" Write blocks of sites to snps_matrix.bin; no header is written without <sample_ids> (shards) """
+	def __init__(self, path, sample_ids=None):
+		self.name = path
+		self.file = io.open(path, 'wb')
+		if sample_ids is not None:
+			write_header(self.file, sample_ids)
+
+	def write_block(self, site_ids, minor_counts, depths):
+		if len(site_ids) > 0:
+			self.file.write(encode_block(site_ids, minor_counts, depths))
+
+	def close(self):
+		self.file.close()
+
+def index_path(path):
+	return '%s.idx.npy' % path
+
+def scan_blocks(path):
+	""" Return array of (byte offset, first site id, number of sites) for each block of file """
+	blocks = []
+	with io.open(path, 'rb') as infile:
+		read_header(infile)
+		while True:
+			offset = infile.tell()
+			header = infile.read(BLOCK_HEADER.size)
+			if len(header) < BLOCK_HEADER.size:
+				break
+			magic, nsites, nsamples, count_bytes = BLOCK_HEADER.unpack(header)
+			if magic != BLOCK_MAGIC:
+				raise IOError("Corrupt block at byte %s of %s" % (offset, path))
+			sizes = np.frombuffer(infile.read(4 * (1 + 2 * nsamples)), dtype=np.uint32)
+			first_site = np.frombuffer(zlib.decompress(infile.read(int(sizes[0]))), dtype=np.int64)[0]
+			infile.seek(int(sizes[1:].sum(dtype=np.int64)), 1)
+			blocks.append((offset, first_site, nsites))
+	return np.array(blocks, dtype=np.int64).reshape(-1, 3)
+
+def write_index(path):
+	""" Write block index of snps_matrix.bin """
+	np.save(index_path(path), scan_blocks(path))
+
+def read_index(path):
+	""" Return block index of snps_matrix.bin, scanning the file if the index is missing or out of date """
+	if os.path.exists(index_path(path)) and os.path.getmtime(index_path(path)) >= os.path.getmtime(path):
+		return np.load(index_path(path))
+	return scan_blocks(path)
+
+class MatrixReader:
+	""" Read blocks of snps_matrix.bin
+		With <columns>, only those sample columns (indexes into sample_ids) are read and decompressed """
+	def __init__(self, path, columns=None):
+		self.path = path
+		self.file = io.open(path, 'rb')
+		self.sample_ids = read_header(self.file)
+		self.columns = np.arange(len(self.sample_ids)) if columns is None else np.asarray(columns, dtype=np.int64)
+
+	def read_block(self, offset=None):
+		""" Return (site ids, sites x columns minor allele freqs, sites x columns depths) of next block or block at <offset>
+			Returns None at end of file """
+		if offset is not None:
+			self.file.seek(offset)
+		header = self.file.read(BLOCK_HEADER.size)
+		if len(header) < BLOCK_HEADER.size:
+			return None
+		magic, nsites, nsamples, count_bytes = BLOCK_HEADER.unpack(header)
+		if magic != BLOCK_MAGIC:
+			raise IOError("Corrupt block in %s" % self.path)
+		sizes = np.frombuffer(self.file.read(4 * (1 + 2 * nsamples)), dtype=np.uint32).astype(np.int64)
+		starts = np.concatenate([[0], np.cumsum(sizes)])
+		if len(self.columns) == nsamples:
+			data = self.file.read(int(starts[-1]))
+			segment = lambda i: zlib.decompress(data[starts[i]:starts[i+1]])
+		else:
+			# read only segments of selected columns, then skip to next block
+			segments, position = {}, self.file.tell()
+			for i in np.sort(np.concatenate([[0], 1 + self.columns, 1 + nsamples + self.columns])):
+				self.file.seek(position + int(starts[i]))
+				segments[i] = self.file.read(int(sizes[i]))
+			self.file.seek(position + int(starts[-1]))
+			segment = lambda i: zlib.decompress(segments[i])
+		site_ids = np.frombuffer(segment(0), dtype=np.int64)
+		minor_counts = np.empty((nsites, len(self.columns)), dtype=np.int64)
+		depths = np.empty((nsites, len(self.columns)), dtype=np.int64)
+		for index, column in enumerate(self.columns):
+			minor_counts[:, index] = np.frombuffer(segment(1 + column), dtype=count_dtype(count_bytes))
+			depths[:, index] = np.frombuffer(segment(1 + nsamples + column), dtype=count_dtype(count_bytes))
+		with np.errstate(invalid='ignore', divide='ignore'):
+			freqs = np.where(depths > 0, minor_counts / depths.astype(float), 0.0)
+		return site_ids, freqs, depths
+
+	def __iter__(self):
+		""" Yield blocks from current position to end of file """
+		while True:
+			block = self.read_block()
+			if block is None:
+				break
+			yield block
+
+	def close(self):
+		self.file.close()
+
+def site_index_path(dir):
+	return '%s/snps_index.npz' % dir
+
+def row_offsets(path):
+	""" Return byte offset of every INDEX_ROWS-th row of table, not counting its header line """
+	offsets = []
+	size = os.path.getsize(path)
+	with io.open(path, 'rb') as infile:
+		position, lines = 0, 0 # bytes and lines read so far; row r starts after line r (the header is line 0)
+		while True:
+			chunk = infile.read(READ_SIZE)
+			if not chunk:
+				break
+			ends = np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == 10)
+			first = (-lines) % INDEX_ROWS # first line in chunk that ends before an indexed row
+			offsets.append(position + ends[first::INDEX_ROWS] + 1)
+			position += len(chunk)
+			lines += len(ends)
+	offsets = np.concatenate(offsets) if offsets else np.zeros(0, dtype=np.int64)
+	return offsets[offsets < size].astype(np.int64)
+
+def write_site_index(dir, tables):
+	""" Write site index of merged tables in <dir>; <tables> maps text table types to file names """
+	site_ids, ref_pos, contigs, contig_rows = [], [], [], []
+	rows = 0
+	columns = ['site_id', 'ref_id', 'ref_pos']
+	for chunk in pd.read_csv('%s/%s' % (dir, tables['info']), sep='\t', usecols=columns, dtype={'ref_id':str}, chunksize=1000000):
+		if len(chunk) == 0: # no sites passed filters; the index is empty
+			continue
+		ref_ids = chunk['ref_id'].values
+		for start in np.flatnonzero(np.r_[True, ref_ids[1:] != ref_ids[:-1]]):
+			if not contigs or contigs[-1] != ref_ids[start]: # a chunk may continue the last contig
+				contigs.append(ref_ids[start])
+				contig_rows.append(rows + start)
+		site_ids.append(chunk['site_id'].values.astype(np.int64))
+		ref_pos.append(chunk['ref_pos'].values.astype(np.int64))
+		rows += len(chunk)
+	arrays = {'site_ids': np.concatenate(site_ids) if site_ids else np.zeros(0, dtype=np.int64),
+			  'ref_pos': np.concatenate(ref_pos) if ref_pos else np.zeros(0, dtype=np.int64),
+			  'contigs': np.array(contigs, dtype=str),
+			  'contig_rows': np.array(contig_rows + [rows], dtype=np.int64)}
+	for ftype, name in tables.items():
+		arrays['offsets_%s' % ftype] = row_offsets('%s/%s' % (dir, name))
+	np.savez(site_index_path(dir), **arrays)
+
+class SiteIndex:
+	""" Find rows of merged tables by site_id or region """
+	def __init__(self, path):
+		arrays = np.load(path)
+		self.site_ids = arrays['site_ids']
+		self.ref_pos = arrays['ref_pos']
+		self.contigs = arrays['contigs']
+		self.contig_rows = arrays['contig_rows']
+		self.offsets = dict([(name.split('_', 1)[1], arrays[name]) for name in arrays.files if name.startswith('offsets_')])
+		self.order = None if np.all(np.diff(self.site_ids) > 0) else np.argsort(self.site_ids, kind='stable')
+
+	def site_rows(self, site_ids):
+		""" Return sorted rows of sites in <site_ids>; ids not in tables are ignored """
+		site_ids = np.asarray(site_ids, dtype=np.int64)
+		if len(self.site_ids) == 0:
+			return np.zeros(0, dtype=np.int64)
+		sorted_ids = self.site_ids if self.order is None else self.site_ids[self.order]
+		rows = np.searchsorted(sorted_ids, site_ids).clip(0, len(sorted_ids) - 1)
+		rows = rows[sorted_ids[rows] == site_ids]
+		return np.unique(rows if self.order is None else self.order[rows])
+
+	def region_rows(self, ref_id, start=None, end=None):
+		""" Return sorted rows of sites on <ref_id> with start <= ref_pos <= end (1-based, inclusive) """
+		rows = []
+		for run in np.flatnonzero(self.contigs == ref_id):
+			first, last = self.contig_rows[run], self.contig_rows[run+1]
+			positions = self.ref_pos[first:last]
+			lo = first + (np.searchsorted(positions, start, side='left') if start is not None else 0)
+			hi = first + (np.searchsorted(positions, end, side='right') if end is not None else len(positions))
+			rows.append(np.arange(lo, hi))
+		return np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+
+	def row_offset(self, ftype, row):
+		""" Return (byte offset of nearest indexed row at or before <row> in table <ftype>, number of rows to skip) """
+		return int(self.offsets[ftype][row // INDEX_ROWS]), row % INDEX_ROWS
+
+def read_site_index(dir):
+	""" Return SiteIndex of merged tables in <dir>, or None if it is missing or older than snps_info.txt """
+	path = site_index_path(dir)
+	if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime('%s/snps_info.txt' % dir):
+		return SiteIndex(path)
+	return None
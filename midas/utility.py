@@ -5,6 +5,7 @@
 # Freely distributed under the GNU General Public License (GPLv3)
 
 import io, os, stat, sys, resource, gzip, platform, bz2, Bio.SeqIO
+from midas import bgzf
 
 __version__ = '1.3.0'
 
@@ -78,36 +79,163 @@ def parallel_old(function, list, threads):
 			if process.is_alive(): indexes.append(index)
 		processes = [processes[i] for i in indexes]
 
-def parallel(function, argument_list, threads, no_results=False):
-	""" Based on: https://gist.github.com/admackin/003dd646e5fadee8b8d6 """
-	import multiprocessing as mp
-	import signal
-	import time
-
-	def init_worker():
-		signal.signal(signal.SIGINT, signal.SIG_IGN)
+class Executor:
+	""" Bounded pool of worker processes that can be reused across calls
+		Jobs are (function, arguments) pairs; results stream back in order of completion.
+		The first failed job cancels the remaining jobs and is re-raised with its traceback.
+		Workers are forked when the pool starts, so they see module globals set before then. """
+	def __init__(self, threads):
+		self.threads = max(1, int(threads))
+		self.pool = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.shutdown()
+
+	def start(self):
+		""" Start worker processes if not already running """
+		import multiprocessing as mp
+		from concurrent.futures import ProcessPoolExecutor
+		if self.pool is None:
+			context = mp.get_context('fork') if 'fork' in mp.get_all_start_methods() else None
+			self.pool = ProcessPoolExecutor(self.threads, mp_context=context, initializer=init_worker)
+		return self.pool
+
+	def shutdown(self, terminate=False):
+		""" Stop worker processes; running jobs are killed if <terminate> """
+		if self.pool is None:
+			return
+		processes = list((getattr(self.pool, '_processes', None) or {}).values())
+		if terminate:
+			for process in processes: process.terminate()
+		self.pool.shutdown(wait=not terminate, cancel_futures=True)
+		if terminate:
+			for process in processes: process.join()
+		self.pool = None
+
+	def imap(self, function, argument_list, progress=None):
+		""" Yield (index, result) for each tuple of arguments as jobs complete """
+		from concurrent.futures import as_completed
+		pool = self.start()
+		futures = {}
+		for index, arguments in enumerate(argument_list):
+			futures[pool.submit(function, *arguments)] = index
+		tracker = Progress(progress, len(futures)) if progress else None
+		try:
+			for future in as_completed(futures):
+				result = future.result() # re-raises exception from worker
+				if tracker: tracker.advance()
+				yield futures[future], result
+		except KeyboardInterrupt:
+			self.shutdown(terminate=True)
+			sys.exit("\nKeyboardInterrupt")
+		except BaseException:
+			self.shutdown(terminate=True)
+			raise
+
+	def map(self, function, argument_list, progress=None):
+		""" Run jobs and return list of results in the same order as <argument_list> """
+		argument_list = list(argument_list)
+		results = [None] * len(argument_list)
+		for index, result in self.imap(function, argument_list, progress):
+			results[index] = result
+		return results
+
+class Progress:
+	""" Report number of completed jobs at most every <interval> seconds """
+	def __init__(self, label, total, interval=30):
+		import time
+		self.label = label
+		self.total = total
+		self.done = 0
+		self.interval = interval
+		self.last = time.time()
+
+	def advance(self):
+		import time
+		self.done += 1
+		if self.done == self.total or time.time() - self.last >= self.interval:
+			self.last = time.time()
+			sys.stdout.write("    %s: %s/%s done\n" % (self.label, self.done, self.total))
+			sys.stdout.flush()
+
+class Scheduler:
+	""" Run a changing set of jobs on one pool of <threads> worker processes
+		Jobs are queued with add() and the lowest <priority> job starts whenever a worker is idle
+		and its open files and memory fit in the file-descriptor and memory budgets. A job's callback runs
+		in the parent process with the job's result and may queue further jobs, e.g. the next phase of a pipeline. """
+	def __init__(self, threads, max_open=None, max_memory=None):
+		import resource
+		self.executor = Executor(threads)
+		self.max_open = max_open or int(0.8 * resource.getrlimit(resource.RLIMIT_NOFILE)[0])
+		self.max_memory = max_memory or available_memory()
+		self.queue = [] # heap of (priority, order, job)
+		self.running = {} # future: job
+		self.open_files = 0
+		self.memory = 0
+		self.order = 0
+
+	def add(self, function, arguments, priority=0, files=1, callback=None, memory=0):
+		""" Queue job; <files> is the number of files it keeps open at once, <memory> its estimated peak bytes """
+		import heapq
+		heapq.heappush(self.queue, (priority, self.order, (function, arguments, files, callback, memory)))
+		self.order += 1
+
+	def launch(self):
+		""" Start queued jobs while workers, file descriptors and memory are free """
+		import heapq
+		pool = self.executor.start()
+		while self.queue and len(self.running) < self.executor.threads:
+			files, memory = self.queue[0][2][2], self.queue[0][2][4]
+			if self.running and (self.open_files + files > self.max_open or self.memory + memory > self.max_memory):
+				break # wait for running jobs to release resources; a lone job always runs
+			priority, order, job = heapq.heappop(self.queue)
+			self.running[pool.submit(job[0], *job[1])] = job
+			self.open_files += files
+			self.memory += memory
+
+	def run(self):
+		""" Run until all jobs, including those queued by callbacks, are done """
+		from concurrent.futures import wait, FIRST_COMPLETED
+		with self.executor:
+			try:
+				self.launch()
+				while self.running:
+					done = wait(self.running, return_when=FIRST_COMPLETED)[0]
+					for future in done:
+						function, arguments, files, callback, memory = self.running.pop(future)
+						self.open_files -= files
+						self.memory -= memory
+						result = future.result() # re-raises exception from worker
+						if callback: callback(result)
+					self.launch()
+			except KeyboardInterrupt:
+				self.executor.shutdown(terminate=True)
+				sys.exit("\nKeyboardInterrupt")
+			except BaseException:
+				self.executor.shutdown(terminate=True)
+				raise
+
+def available_memory():
+	""" Return bytes of available physical memory, or infinity if unknown """
+	try:
+		return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+	except (ValueError, OSError, AttributeError):
+		return float('Inf')
 
-	pool = mp.Pool(int(threads), init_worker)
+def init_worker():
+	""" Leave handling of KeyboardInterrupt to the parent process """
+	import signal
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
 
-	try:
-		results = []
-		for arguments in argument_list:
-			p = pool.apply_async(function, args=arguments)
-			results.append(p)
-		pool.close()
-
-		while True:
-			if all(r.ready() for r in results):
-				pool.join()
-				if no_results:
-					return
-				return [r.get() for r in results]
-			time.sleep(1)
-
-	except KeyboardInterrupt:
-		pool.terminate()
-		pool.join()
-		sys.exit("\nKeyboardInterrupt")
+def parallel(function, argument_list, threads, no_results=False, progress=None):
+	""" Run function on each tuple of arguments using a pool of <threads> processes """
+	with Executor(threads) as executor:
+		results = executor.map(function, argument_list, progress)
+	if not no_results:
+		return results
 
 def add_executables(args):
 	""" Identify relative file and directory paths """
@@ -173,7 +301,9 @@ def check_database(args):
 			sys.exit(error)
 
 def iopen(inpath, mode='r'):
-	""" Open input file for reading regardless of compression [gzip, bzip] or python version """
+	""" Open input file for reading regardless of compression [gzip, bzip] or python version
+		In python3, gzip files are written as BGZF compressed on multiple threads,
+		and decompressed on background threads when read (see midas/bgzf.py) """
 	ext = inpath.split('.')[-1]
 	# Python2
 	if sys.version_info[0] == 2:
@@ -182,7 +312,7 @@ def iopen(inpath, mode='r'):
 		else: return open(inpath, mode)
 	# Python3
 	elif sys.version_info[0] == 3:
-		if ext == 'gz': return io.TextIOWrapper(gzip.open(inpath, mode))
+		if ext == 'gz': return bgzf.open(inpath, mode)
 		elif ext == 'bz2': return bz2.BZ2File(inpath, mode)
 		else: return open(inpath, mode)
 
@@ -223,32 +353,12 @@ def check_bamfile(args, bampath):
 		sys.exit(err_message)
 
 def read_genes(species_id, iggdb):
-	""" Read in gene coordinates from features file """
-	genome = read_genome(iggdb, species_id)
-	raise Exception("Genome feature files for IGGdb are not yet available.")
-	genes = []
-	basename = '%s/rep_genomes/%s/genome.features' % (db, species_id)
-	if os.path.exists(basename):
-		fpath = basename
-	elif os.path.exists(basename+'.gz'):
-		fpath = basename+'.gz'
-	else:
-		sys.exit("\nError: rep genome for %s not found\n" % species_id)
-	for gene in parse_file(fpath):
-		if 'gene_type' in gene and gene['gene_type'] != 'CDS':
-			continue
-		else:
-			gene['start'] = int(gene['start'])
-			gene['end'] = int(gene['end'])
-			gene['seq'] = get_gene_seq(gene, genome[gene['scaffold_id']])
-			genes.append(gene)
-
-	# sort genes
-	coords = [[gene['scaffold_id'], gene['start'], -gene['end']] for gene in genes]
-	indexes = sorted(range(len(coords)), key=lambda k: coords[k])
-	sorted_genes = [genes[i] for i in indexes]
-
-	return {'list':sorted_genes, 'index':0}
+	""" Read in interval index of gene coordinates from features file of representative genome """
+	from midas import annotation
+	fpath = annotation.repgenome_features_path(species_id, iggdb)
+	if fpath is None:
+		sys.exit("\nError: genome features for %s not found\n" % species_id)
+	return annotation.read_gene_index(fpath)
 
 
 def read_genome(iggdb, species_id):
@@ -185,37 +185,38 @@ if __name__ == '__main__':
 	if args['site_list']: 
 		site_list = set([_.rstrip() for _ in open(args['site_list'])])
 	
-	# loop over genomic sites
-	sites = parse_snps.fetch_sites(species, samples)
+	# loop over blocks of genomic sites; with a site list, only those sites are read
+	blocks = parse_snps.fetch_blocks(species, samples, site_ids=site_list if args['site_list'] else None)
 	retained_sites = 0
-	for index, site in enumerate(sites):
+	for block in blocks:
 	
 		# stop early
 		if retained_sites >= args['max_sites']: break
 			
-		# prune low quality samples for site:
-		#   site.samples['sample'].keep = [True|False]
-		site.flag_samples(args['site_depth'], args['site_ratio'], args['allele_support'])
+		# prune low quality samples for sites:
+		#   block.sample_keep = sites x samples [True|False]
+		block.flag_samples(args['site_depth'], args['site_ratio'], args['allele_support'])
 		
 		# compute site summary stats
-		#   site.prevalence
-		#   site.pooled_maf
-		site.summary_stats(weight=False)
+		#   block.prevalence
+		#   block.pooled_maf
+		block.summary_stats(weight=False)
 		
-		# filter genomic site
-		#   site.keep = [True|False]
+		# filter genomic sites
+		#   block.keep = [True|False]
 		if not args['site_list']:
-			site.filter(args['site_prev'], args['site_maf'], args['locus_type'], args['site_type']) 
-		elif site.id in site_list:
-			site.keep = True
+			block.filter(args['site_prev'], args['site_maf'], args['locus_type'], args['site_type']) 
 		else:
-			site.keep = False
+			block.keep = np.isin(block.id, list(site_list))
 		
 		# store consensus
-		if site.keep:
-			retained_sites += 1		
-			for sample in site.samples.values():
-				samples[sample.id].consensus += site.fetch_consensus(sample)
+		kept = np.flatnonzero(block.keep)
+		if retained_sites + len(kept) > args['max_sites']:
+			kept = kept[:int(args['max_sites'] - retained_sites)]
+		retained_sites += len(kept)
+		consensus = block.fetch_consensus()[kept]
+		for column, sample in enumerate(block.sample_list):
+			samples[sample.id].consensus += ''.join(consensus[:, column])
 
 	# write consensus
 	write_consensus(args, samples)
@@ -5,7 +5,7 @@
 # Freely distributed under the GNU General Public License (GPLv3)
 
 import argparse, sys, os, gzip, numpy as np, pandas as pd, itertools
-from midas import utility
+from midas import utility, gene_matrix
 
 def parse_arguments():
 	""" Parse command line arguments """
@@ -36,7 +36,7 @@ compare_genes.py /path/to/genes --out distances.txt --cutoff 0.75
 """)
 	parser.add_argument('indir', metavar='PATH', type=str,
 		help="""Path to output from `merge_midas.py genes` for one species
-directory should be named according to a species_id and contains files 'genes_*.txt')""")
+directory should be named according to a species_id and contains files 'genes_*.txt' or 'genes_matrix.npz')""")
 	parser.add_argument('--out', metavar='PATH', type=str, default="/dev/stdout",
 		help="""Path to output file""")
 	parser.add_argument('--max_genes', metavar='INT', type=int,
@@ -56,6 +56,9 @@ directory should be named according to a species_id and contains files 'genes_*.
 
 def init_paths(args):
 	paths = {}
+	if os.path.isfile('%s/genes_matrix.npz' % args['indir']): # merge_midas.py genes --matrix_format sparse
+		paths['matrix'] = '%s/genes_matrix.npz' % args['indir']
+		return paths
 	for ext in ['presabs', 'depth', 'copynum']:
 		inpath = '%s/genes_%s.txt' % (args['indir'], ext)
 		if os.path.isfile(inpath):
@@ -64,6 +67,17 @@ def init_paths(args):
 			sys.exit("\nError: Input file does not exist: %s\n" % inpath)
 	return paths
 
+def read_copynum(args):
+	""" Read gene copy-number matrix (genes x samples) from genes_copynum.txt or genes_matrix.npz """
+	if 'matrix' in args:
+		matrix = gene_matrix.read_gene_matrix(args['matrix'])
+		rows = np.arange(min(matrix.shape[0], args['max_genes'] or matrix.shape[0]))
+		samples = matrix.sample_ids[:args['max_samples']] if args['max_samples'] else matrix.sample_ids
+		data = matrix.dense('copynum', rows)[:, :len(samples)]
+		return pd.DataFrame(data, index=pd.Index(matrix.gene_ids[rows], name='gene_id'), columns=samples)
+	usecols = range(args['max_samples']+1) if args['max_samples'] else None
+	return pd.read_table(args['copynum'], index_col='gene_id', nrows=args['max_genes'], usecols=usecols)
+
 def compute_euclidian(df, s1, s2):
 	return(np.sqrt(sum((df[s1]-df[s2])**2)))
 
@@ -104,8 +118,7 @@ if __name__ == '__main__':
 	args = parse_arguments()
 	
 	print ("Reading gene copy-number matrix\n")
-	usecols = range(args['max_samples']+1) if args['max_samples'] else None
-	data = pd.read_table(args['copynum'], index_col='gene_id', nrows=args['max_genes'], usecols=usecols )
+	data = read_copynum(args)
 	
 	if args['dtype'] == 'presabs':
 		print ("Converting to gene presence-absence matrix\n")
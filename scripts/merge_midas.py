@@ -78,6 +78,8 @@ By default the MIDAS_DB environmental variable is used""")
 	parser.add_argument('--max_samples', type=int, metavar='INT',
 		help="""Maximum number of samples to process.
 Useful for testing (use all)""")
+	parser.add_argument('--threads', type=int, default=1, metavar='INT',
+		help="Number of species profiles to read at once (1)")
 	args = vars(parser.parse_args())
 	return args
 
@@ -110,6 +112,11 @@ merge_midas.py genes /path/to/outdir -i /path/to/samples -t dir --max_species 1
 	parser.add_argument('program', help=argparse.SUPPRESS)
 	parser.add_argument('outdir', type=str,
 		help="Directory for output files.\nA subdirectory will be created for each species_id")
+	parser.add_argument('--threads', type=int, default=1, metavar='INT',
+		help="Number of species to merge at once (1)")
+	parser.add_argument('--max_memory', type=float, metavar='FLOAT',
+		help="""Memory in GB available for gene matrices of species merged at once (available memory)
+Species that do not fit wait for others to finish""")
 	io = parser.add_argument_group('Input/Output')
 	io.add_argument('-i', type=str, dest='input', required=True,
 		help="""Input to sample directories output by run_midas.py; see '-t' for details""")
@@ -121,6 +128,10 @@ merge_midas.py genes /path/to/outdir -i /path/to/samples -t dir --max_species 1
 	io.add_argument('-d', type=str, dest='db', default=os.environ['MIDAS_DB'] if 'MIDAS_DB' in os.environ else None,
 		help="""Path to reference database.
 By default, the MIDAS_DB environmental variable is used""")
+	io.add_argument('--matrix_format', choices=['text', 'sparse'], default='text',
+		help="""Format of gene matrices (text)
+  text: genes_presabs.txt, genes_copynum.txt, genes_depth.txt and genes_reads.txt
+  sparse: non-zero values of all matrices in genes_matrix.npz, read by compare_genes.py""")
 	species = parser.add_argument_group('Species filters (select subset of species from INPUT)')
 	species.add_argument('--min_samples', type=int, default=1, metavar='INT',
 		help="""All species with >= MIN_SAMPLES (1)""")
@@ -134,9 +145,11 @@ By default, the MIDAS_DB environmental variable is used""")
 	sample.add_argument('--max_samples', type=int, metavar='INT',
 		help="""Maximum number of samples to process. Useful for testing (use all)""")
 	gene = parser.add_argument_group('Quantification')
-	gene.add_argument('--cluster_pid', type=str, dest='cluster_pid', default='95', choices=['75', '80', '85', '90', '95', '99'],
-		help="""In the database, pan-genomes are defined at 6 different %% identity clustering cutoffs.
-CLUSTER_PID allows you to quantify gene content for any of these sets of gene clusters.
+	gene.add_argument('--cluster_pid', type=str, dest='cluster_pid', default='95', metavar='PID',
+		help="""In the database, pan-genomes are defined at 6 different %% identity clustering cutoffs:
+75, 80, 85, 90, 95, 99. CLUSTER_PID allows you to quantify gene content for any of these sets of gene clusters.
+Comma-separated values (ex: 95,85,75) quantify several sets in one pass over the samples,
+with the matrices of each written to OUTDIR/species_id/centroid_PID.
 By default, gene content is reported for genes clustered at 95%% identity
 """)
 	gene.add_argument('--min_copy', type=float, default=0.35, metavar='FLOAT',
@@ -178,6 +191,12 @@ merge_midas.py snps /path/to/outdir -i /path/to/samples -t dir --core-sites
 
 4) Run a quick test:
 merge_midas.py snps /path/to/outdir -i /path/to/samples -t dir --max_species 1 --max_samples 10 --max_sites 1000
+
+5) Split one species across 4 independent jobs, then stitch their outputs together:
+merge_midas.py snps /path/to/outdir --species_id Bacteroides_vulgatus_57955 -i /path/to/samples -t dir --shard 1/4
+...
+merge_midas.py snps /path/to/outdir --species_id Bacteroides_vulgatus_57955 -i /path/to/samples -t dir --shard 4/4
+merge_midas.py snps /path/to/outdir --species_id Bacteroides_vulgatus_57955 -i /path/to/samples -t dir --finalize
 	""")
 	parser.add_argument('program', help=argparse.SUPPRESS)
 	parser.add_argument('outdir', type=str,
@@ -195,6 +214,10 @@ merge_midas.py snps /path/to/outdir -i /path/to/samples -t dir --max_species 1 -
 	io.add_argument('-d', type=str, dest='db', default=os.environ['MIDAS_DB'] if 'MIDAS_DB' in os.environ else None,
 		help="""Path to reference database
 By default, the MIDAS_DB environmental variable is used""")
+	io.add_argument('--matrix_format', choices=['text', 'binary'], default='text',
+		help="""Format of per-sample SNP matrices (text)
+  text: snps_freq.txt and snps_depth.txt
+  binary: compressed blocks of sites in snps_matrix.bin, read by the analysis scripts""")
 	presets = parser.add_argument_group("Presets (option groups for easily...)")
 
 	snps = parser.add_argument_group("Presets")
@@ -251,6 +274,25 @@ A high value selects for sites in the core-genome (i.e. present in nearly all st
 A low value includes sites in variable regions and/or with abnormally high read depth""")
 	snps.add_argument('--max_sites', type=int, default=float('Inf'), metavar='INT',
 		help="""Maximum number of sites to include in output (use all). Useful for quick tests """)
+	snps.add_argument('--sparse', default=False, action='store_true',
+		help="""Inputs were generated with 'run_midas.py snps --sparse' (False)
+Sites are joined across samples and sites missing from a sample get zero counts.
+Output sites are sorted by ref_id and ref_pos""")
+	snps.add_argument('--incremental', default=False, action='store_true',
+		help="""Keep allele counts of samples in OUTDIR/<species>/counts (False)
+When rerun with more samples, only the new samples are read and all output tables are rewritten.
+The sites of the first run are kept; remove the counts directory to start over""")
+
+	shards = parser.add_argument_group("Sharding (split one species across independent jobs)")
+	shards.add_argument('--region', type=str, metavar='CHAR',
+		help="""Only merge sites in region 'contig:start-end' (1-based, inclusive) or 'contig'
+Outputs and a manifest are written to OUTDIR/<species>/shards/<region>""")
+	shards.add_argument('--shard', type=str, metavar='INT/INT',
+		help="""Only merge shard i of N equally sized sets of consecutive sites, e.g. 2/8
+Outputs and a manifest are written to OUTDIR/<species>/shards/shard_<i>_of_<N>""")
+	shards.add_argument('--finalize', default=False, action='store_true',
+		help="""Stitch together outputs of all --region or --shard jobs into final output files.
+Use the same input and filters as the sharded jobs""")
 
 	args = vars(parser.parse_args())
 	args = add_snp_presets(args)
@@ -288,12 +330,29 @@ def check_arguments(program, args):
 	if platform.system() not in ['Linux', 'Darwin']:
 		sys.exit("\nError: Operating system '%s' not supported\n" % system())
 	
+	if 'incremental' in args and args['incremental'] and args['sparse']:
+		sys.exit("\nError: --incremental cannot be used with --sparse, since new samples may add sites\n")
+
+	if 'shard' in args and args['shard']:
+		if args['region']:
+			sys.exit("\nError: --region cannot be used with --shard\n")
+		try: shard, shards = [int(_) for _ in args['shard'].split('/')]
+		except ValueError: sys.exit("\nError: --shard must be formatted as i/N, e.g. 2/8\n")
+		if not 1 <= shard <= shards:
+			sys.exit("\nError: --shard i/N requires 1 <= i <= N\n")
+
+	if 'cluster_pid' in args:
+		args['cluster_pid'] = args['cluster_pid'].split(',')
+		for pid in args['cluster_pid']:
+			if pid not in ['75', '80', '85', '90', '95', '99']:
+				sys.exit("\nError: --cluster_pid must be one or more of 75, 80, 85, 90, 95, 99\n")
+
 	for arg in ['allele_freq', 'fract_cov', 'site_prev']:
 		if arg in args and args[arg] and (args[arg] < 0 or args[arg] > 1):
 			sys.exit("\nError: --%s must be between 0.0 and 1.0\n" % arg)
 
 	for arg in ['max_samples', 'min_samples', 'max_species', 'threads', 'site_depth',
-	            'max_sites', 'sample_depth', 'min_copy', 'site_ratio']:
+	            'max_sites', 'sample_depth', 'min_copy', 'site_ratio', 'max_memory']:
 		if arg in args and args[arg] and (args[arg] < 0):
 			sys.exit("\nError: --%s cannot be a negative value\n" % arg)
 
@@ -351,6 +410,7 @@ def print_species_arguments(args):
 	print ("Output directory: %s" % args['outdir'])
 	print ("Minimum coverage for estimating prevalence: %s" % args['min_cov'])
 	if args['max_samples']: print ("Keep <= %s samples" % args['max_samples'])
+	print ("Number of CPUs to use: %s" % args['threads'])
 	print ("===============================")
 	print ("")
 
@@ -373,9 +433,11 @@ def print_genes_arguments(args):
 		print ("  keep samples with >=%s mean coverage across genes with non-zero coverage" % args['sample_depth'])
 	if args['max_samples']: print ("  keep <= %s samples" % args['max_samples'])
 	print ("Gene quantification criterea:")
-	print ("  quantify genes clustered at %s%% identity" % args['cluster_pid'])
-	print ("  present (1): genes with copy number >= %s" % args['min_copy'])
-	print ("  absent (0): genes with copy number < %s" % args['min_copy'])
+	print ("  quantify genes clustered at %s%% identity" % '%, '.join(args['cluster_pid']))
+	print ("  present (1): genes with copy number >= %s and > 0" % args['min_copy'])
+	print ("  absent (0): genes with copy number < %s or without reads" % args['min_copy'])
+	print ("Output matrix format: %s" % args['matrix_format'])
+	print ("Number of CPUs to use: %s" % args['threads'])
 	print ("===============================")
 	print ("")
 
@@ -387,6 +449,7 @@ def print_snps_arguments(args):
 	print ("Input: %s" % args['input'])
 	print ("Input type: %s" % args['intype'])
 	print ("Output directory: %s" % args['outdir'])
+	print ("Output matrix format: %s" % args['matrix_format'])
 	print ("SNP definition: >=%s%% allele frequency" % (100*args['allele_freq']))
 	print ("Species selection criteria:")
 	if args['species_id']: print ("  keep species ids: %s" % args['species_id'].split(','))
@@ -4,7 +4,7 @@
 # Copyright (C) 2015 Stephen Nayfach
 # Freely distributed under the GNU General Public License (GPLv3)
 
-import argparse, sys, os, numpy as np, random, csv
+import argparse, sys, os, numpy as np, csv
 from midas.utility import print_copyright
 from midas.analyze import parse_snps
 
@@ -67,6 +67,8 @@ directory should be named according to a species_id and contains files 'snps_*.t
 		help="""randomly select N samples from each genomic site""")
 	diversity.add_argument('--rand_sites', type=float, metavar='FLOAT',
 		help="""randomly select X proportion of high-quality genomic sites""")
+	diversity.add_argument('--seed', type=int, metavar='INT',
+		help="""seed for random selection of reads, samples and sites (random)""")
 	diversity.add_argument('--snp_maf', type=float, metavar='FLOAT', default=0.01,
 		help="""minor allele frequency cutoff for determining if a site is a SNP (0.01)""")
 	diversity.add_argument('--consensus', action='store_true', default=False,
@@ -136,6 +138,7 @@ def print_args(args):
 	lines.append("  replace_reads: %s" % args['replace_reads'])
 	lines.append("  rand_samples: %s" % args['rand_samples'])
 	lines.append("  rand_sites: %s" % args['rand_sites'])
+	lines.append("  seed: %s" % args['seed'])
 	lines.append("  snp_maf: %s" % args['snp_maf'])
 	lines.append("  consensus: %s" % args['consensus'])
 	lines.append("Sample filters:")
@@ -177,7 +180,7 @@ def check_args(args):
 		sys.exit("\nError: --site_prev must be between 0 and 1\n")
 	if not 0 <= args['fract_cov'] <= 1:
 		sys.exit("\nError: --fract_cov must be between 0 and 1\n")
-	if args['rand_reads'] > args['site_depth'] and not args['replace_reads']:
+	if args['rand_reads'] and args['rand_reads'] > args['site_depth'] and not args['replace_reads']:
 		sys.exit("\nError: --rand_reads cannot exceed --site_depth when --replace_reads=False\n")
 	if args['rand_sites'] and (args['rand_sites'] < 0 or args['rand_sites'] > 1):
 		sys.exit("\nError: --rand_sites must be between 0 and 1\n")
@@ -226,7 +229,7 @@ def init_pi(args, samples):
 
 def compute_maf(freq):
 	""" Compute minor allele frequency """
-	return min(freq, 1-freq)
+	return np.minimum(freq, 1-freq)
 
 def compute_pi(freq):
 	""" Compute diversity based on minor allele frequency """
@@ -234,97 +237,102 @@ def compute_pi(freq):
 
 def is_snp(freq, min_maf):
 	""" Determine if a genomic site is a SNP or not """
-	maf = compute_maf(freq)
-	if maf >= min_maf:
-		return True
-	else:
-		return False
-
-def compute_snp_diversity(args, species, samples, progress):
+	return compute_maf(freq) >= min_maf
+
+def add_sites(stats, groups, freq, depth, keep, snp_maf):
+	""" Add diversity at sites x columns arrays <freq> and <depth> where <keep> to (groups x columns) arrays of stats
+		groups: group (gene) of each site; values are added in site order """
+	rows, columns = np.nonzero(keep)
+	index = (groups[rows], columns)
+	np.add.at(stats['pi'], index, compute_pi(freq[rows, columns]))
+	np.add.at(stats['snps'], index, is_snp(freq[rows, columns], snp_maf))
+	np.add.at(stats['sites'], index, 1)
+	np.add.at(stats['depth'], index, depth[rows, columns])
+
+def store_stats(args, samples, pi, stats, genes):
+	""" Store (groups x columns) arrays of stats in Diversity objects """
+	columns = [pi] if args['sample_type'] == 'pooled-samples' else [pi[s.id] for s in samples.values()]
+	for column, diversity in enumerate(columns):
+		for gene, group in (genes.items() if genes else [(None, 0)]):
+			d = diversity[gene] if genes else diversity
+			d.sites = stats['sites'][group, column].item()
+			d.snps = stats['snps'][group, column].item()
+			d.depth = stats['depth'][group, column].item()
+			d.pi = stats['pi'][group, column].item() if d.sites else 0
+			if args['consensus'] and args['sample_type'] == 'per-sample':
+				d.pi = int(d.pi) # consensus frequencies are integers, and so is their diversity
+
+def compute_snp_diversity(args, species, samples, rng, progress):
 
 	pi = init_pi(args, samples)
+
+	# diversity is summed over blocks of sites in (groups x columns) arrays
+	#   groups: genes if --genomic_type=per-gene, else one group
+	#   columns: samples if --sample_type=per-sample, else pooled samples
+	if args['genomic_type'] == 'per-gene':
+		gene_ids = pi.keys() if args['sample_type'] == 'pooled-samples' else next(iter(pi.values())).keys() if pi else []
+		genes = dict([(gene, group) for group, gene in enumerate(gene_ids)])
+	else:
+		genes = None
+	shape = (len(genes) if genes else 1, 1 if args['sample_type'] == 'pooled-samples' else len(samples))
+	stats = {'pi': np.zeros(shape), 'snps': np.zeros(shape, dtype=np.int64),
+			 'sites': np.zeros(shape, dtype=np.int64), 'depth': np.zeros(shape, dtype=np.int64)}
 	
-	# read list of genomic sites to keep
-	if args['site_list']:
-		site_list = [_.rstrip() for _ in open(args['site_list'])]
-		site_index = 0
+	# read list of genomic sites to keep; only those sites are read
+	site_list = [_.rstrip() for _ in open(args['site_list'])] if args['site_list'] else None
 	
 	index = 0
-	for site in parse_snps.fetch_sites(species, samples):
+	for block in parse_snps.fetch_blocks(species, samples, site_ids=site_list):
 				
 		# print progress			
-		if progress and not int(site.id) % 10000:
-			sys.stdout.write(" %s sites processed\r" % site.id)
+		if progress:
+			sys.stdout.write(" %s sites processed\r" % block.id[-1])
 			sys.stdout.flush()
 
 		# stop early
 		if index >= args['max_sites']: break
 		
-		# skip sites not in site_list
-		if args['site_list']:
-			if site_index >= len(site_list):
-				break
-			elif site.id != site_list[site_index]:
-				continue
-			else:
-				site_index += 1
-			
 		#  skip random subset of genomic sites
-		if args['rand_sites'] and random.uniform(0, 1) > args['rand_sites']:
-			continue
+		if args['rand_sites']:
+			block = block.subset(rng.random(len(block)) <= args['rand_sites'])
 			
-		# prune low quality samples for site:
-		#   site.samples['sample'].keep = [True|False]
-		site.flag_samples(args['site_depth'], args['site_ratio'], args['allele_support'])
+		# prune low quality samples for sites:
+		#   block.sample_keep = sites x samples [True|False]
+		block.flag_samples(args['site_depth'], args['site_ratio'], args['allele_support'])
 						
 		# call consensus
 		if args['consensus']:
-			site.call_consensus()
+			block.call_consensus()
 		
 		# compute site summary stats
-		#   site.prevalence
-		#   site.pooled_maf
-		site.summary_stats(args['weight_by_depth'])
+		#   block.prevalence
+		#   block.pooled_maf
+		block.summary_stats(args['weight_by_depth'])
 		
-		# filter genomic site
-		#   site.keep = [True|False]
-		site.filter(args['site_prev'], args['site_maf'], args['locus_type'], args['site_type'])
-		if not site.keep:
-			continue
-		else:
-			index += 1
+		# filter genomic sites
+		#   block.keep = [True|False]
+		block.filter(args['site_prev'], args['site_maf'], args['locus_type'], args['site_type'])
+		kept = np.flatnonzero(block.keep)
+		if index + len(kept) > args['max_sites']:
+			kept = kept[:int(args['max_sites'] - index)]
+		block = block.subset(kept)
+		index += len(block)
 
 		# downsample reads & recompute pooled frequency
-		if args['rand_reads'] and site.pooled_maf > 0.0:
-			site.resample_reads(args['rand_reads'], args['replace_reads'])
-			site.pooled_maf = site.compute_pooled_maf(args['weight_by_depth'])
+		if args['rand_reads']:
+			resampled = np.flatnonzero(block.pooled_maf > 0.0)
+			block.resample_reads(args['rand_reads'], args['replace_reads'], resampled, rng)
+			block.pooled_maf[resampled] = block.compute_pooled_maf(args['weight_by_depth'])[resampled]
 
-		# compute pi for pooled-samples
+		# compute pi for pooled-samples or per-sample
+		groups = np.array([genes[gene_id] for gene_id in block.gene_id], dtype=np.int64) if genes else np.zeros(len(block), dtype=np.int64)
 		if args['sample_type'] == 'pooled-samples':
-			if args['genomic_type'] == 'genome-wide':
-				pi.pi += compute_pi(site.pooled_maf)
-				pi.snps += 1 if is_snp(site.pooled_maf, args['snp_maf']) else 0
-				pi.sites += 1
-			else:
-				pi[site.gene_id].pi += compute_pi(site.pooled_maf)
-				pi[site.gene_id].snps += 1 if is_snp(site.pooled_maf, args['snp_maf']) else 0
-				pi[site.gene_id].sites += 1
-	
-		# compute pi per-sample
+			sites = (len(block), 1)
+			add_sites(stats, groups, block.pooled_maf.reshape(sites), np.zeros(sites, dtype=np.int64), np.ones(sites, dtype=bool), args['snp_maf'])
 		else:
-			for sample in site.samples.values():
-				if sample.keep:
-					if args['genomic_type'] == 'genome-wide':			
-						pi[sample.id].pi += compute_pi(sample.freq)
-						pi[sample.id].snps += 1 if is_snp(sample.freq, args['snp_maf']) else 0
-						pi[sample.id].sites += 1
-						pi[sample.id].depth += sample.depth
-					else:
-						pi[sample.id][site.gene_id].pi += compute_pi(sample.freq)
-						pi[sample.id][site.gene_id].snps += 1 if is_snp(sample.freq, args['snp_maf']) else 0
-						pi[sample.id][site.gene_id].sites += 1
-						pi[sample.id][site.gene_id].depth += sample.depth
-								
+			add_sites(stats, groups, block.freq, block.depth, block.sample_keep, args['snp_maf'])
+
+	store_stats(args, samples, pi, stats, genes)
 	return pi
 
 def write_pi(args, samples, pi):
@@ -372,13 +380,14 @@ if __name__ == '__main__':
 	print_args(args)
 
 	print("\nSelecting subset of samples...")
+	rng = np.random.default_rng(args['seed'])
 	species = parse_snps.Species(args['indir'])
 	samples = parse_snps.fetch_samples(species, args['sample_depth'], args['fract_cov'], args['max_samples'],
-						    		   args['keep_samples'], args['exclude_samples'], args['rand_samples'])
+						    		   args['keep_samples'], args['exclude_samples'], args['rand_samples'], rng)
 	print(" %s samples selected" % len(samples))
 
 	print("Estimating diversity metrics...\n")
-	pi = compute_snp_diversity(args, species, samples, progress=False)
+	pi = compute_snp_diversity(args, species, samples, rng, progress=False)
 
 	write_pi(args, samples, pi)
 
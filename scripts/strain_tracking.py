@@ -128,6 +128,8 @@ useful for quick tests""")
 	parser.add_argument('--max_samples', type=int, metavar='INT',
 		help="""maximum number of samples to process (use all)
 useful for quick tests""")
+	parser.add_argument('--threads', type=int, metavar='INT', default=1,
+		help="""number of threads to use for counting shared markers (1)""")
 
 	args = vars(parser.parse_args())
 	if not os.path.isdir(args['indir']):
@@ -39,6 +39,8 @@ class IGGdb:
             g = self.genomes[genome_id]
             s['repgenome_with_origin'] = genome_id + "." + g['repository'].lower()
             s['repgenome_path'] = f"{self.iggdb_root}/repgenomes/{s['repgenome_with_origin']}.fna"
+            s['repgenome_features_path'] = f"{self.iggdb_root}/repgenomes/{s['repgenome_with_origin']}.features"
+            s['repgenome_annotations_path'] = f"{self.iggdb_root}/repgenomes/{s['repgenome_with_origin']}.annotations.npz"
             s['pangenome_path'] = f"{self.iggdb_root}/pangenomes/{s['species_alt_id']}"
 
 
@@ -30,6 +30,9 @@ def smelt(argv):
     tsprint(my_command)
     _, subcmd, outdir, iggdb_toc = argv
     subcmd = subcmd.replace("-", "_").lower()
+    if subcmd == "annotate_repgenomes":
+        annotate_repgenomes(outdir, iggdb_toc, my_command)
+        return
     SUBCOMMANDS = {
         f"collate_{gdim}": gdim
         for gdim in ["pangenomes", "repgenomes"]
@@ -38,7 +41,7 @@ def smelt(argv):
     try:
         assert gdim in ["pangenomes", "repgenomes"]
     except Exception as e:
-        e.help_text = f"Try a supported subcommand instead of {subcmd}."
+        e.help_text = f"Try a supported subcommand instead of {subcmd}:  collate_pangenomes, collate_repgenomes or annotate_repgenomes."
         raise
     makedirs(outdir, exist_ok=False)
     iggdb = IGGdb(iggdb_toc)
@@ -117,6 +120,45 @@ def smelt(argv):
         tsprint(collation_status_str)
     os.rename(f"{outdir}/temp_{gdim}.fa", f"{outdir}/{gdim}.fa")
 
+def annotate_repgenomes(outdir, iggdb_toc, my_command):
+    # Write per-position site annotation arrays next to each repgenome, where merge_midas.py snps
+    # reads them.  Merging never builds these itself;  without them its output is not annotated.
+    from midas import annotation
+    makedirs(outdir, exist_ok=False)
+    iggdb = IGGdb(iggdb_toc)
+    tsprint("Now annotating sites of repgenomes.")
+    count_successes = 0
+    ticker = ProgressTracker(target=len(iggdb.species_info))
+    failures = []
+    for s in iggdb.species_info:
+        try:
+            features_path = annotation.repgenome_features_path(s['species_id'], iggdb)
+            assert features_path is not None, f"Genome features not found: {s['repgenome_features_path']}"
+            annotation.write_site_annotations(s['repgenome_path'], features_path, s['repgenome_annotations_path'])
+            count_successes += 1
+        except Exception:
+            tsprint(traceback.format_exc())
+            failures.append(s)
+        finally:
+            ticker.advance(1)
+    if not failures:
+        tsprint(f"All {len(iggdb.species_info)} species were processed successfully.")
+    else:
+        tsprint(f"Annotation of {len(failures)} species failed.  Merged SNPs of those species will not be annotated.")
+    annotation_status = {
+        "comment": f"Annotation of repgenomes finished on {time.asctime()} with command '{my_command}'.",
+        "successfully_annotated_species_count": count_successes,
+        "failed_species_count": len(failures),
+        "total_species_count": len(iggdb.species_info),
+        "failed_species_alt_ids": [s['species_alt_id'] for s in failures],
+        "elapsed_time": time.time() - ticker.t_start
+    }
+    annotation_status_str = json.dumps(annotation_status, indent=4)
+    with open(f"{outdir}/repgenomes_annotation_status.json", "w") as pas:
+        chars_written = pas.write(annotation_status_str)
+        assert chars_written == len(annotation_status_str)
+        tsprint(annotation_status_str)
+
 def main():
     try:
         smelt(sys.argv)
@@ -5,6 +5,7 @@ import shutil
 import os
 import subprocess
 import sys
+import gzip
 from distutils.version import StrictVersion
 
 def run(command):
@@ -13,6 +14,29 @@ def run(command):
 	out, err = process.communicate()
 	return(err, process.returncode)
 
+def write_snps_samples(outdir):
+	""" write a small database and 'run_midas.py snps' outputs of 4 samples for one species with 3 sites
+		site 2 is A in samples 1-2 and C in samples 3-4, so their consensus alleles differ """
+	if os.path.exists(outdir): shutil.rmtree(outdir)
+	for dir in ['db/metadata', 'db/pangenomes', 'db/repgenomes']:
+		os.makedirs('%s/%s' % (outdir, dir))
+	with open('%s/db/metadata/species_info.tsv' % outdir, 'w') as f:
+		f.write('species_id\trepresentative_genome\tspecies_alt_id\nsp1\tg1\talt1\n')
+	with open('%s/db/metadata/genome_info.tsv' % outdir, 'w') as f:
+		f.write('genome_id\trepository\tspecies_id\ng1\tPATRIC\tsp1\n')
+	sites = [['A']*4, ['A', 'A', 'C', 'C'], ['AC']*4]
+	for sample in range(4):
+		dir = '%s/samples/s%s/snps' % (outdir, sample)
+		os.makedirs('%s/output' % dir)
+		with open('%s/summary.txt' % dir, 'w') as f:
+			f.write('species_id\tgenome_length\tcovered_bases\tfraction_covered\tmean_coverage\taligned_reads\tmapped_reads\n')
+			f.write('sp1\t3\t3\t1.0\t10.0\t30\t30\n')
+		with gzip.open('%s/output/sp1.snps.gz' % dir, 'wt') as f:
+			f.write('ref_id\tref_pos\tref_allele\tdepth\tcount_a\tcount_c\tcount_g\tcount_t\n')
+			for pos, alleles in enumerate(sites):
+				counts = {'A': 6, 'C': 4} if alleles[sample] == 'AC' else {alleles[sample]: 10}
+				f.write('c1\t%s\tA\t10\t%s\t%s\t0\t0\n' % (pos+1, counts.get('A', 0), counts.get('C', 0)))
+
 class _01_CheckEnv(unittest.TestCase):
 	def setUp(self):
 		self.path_contents = []
@@ -151,14 +175,58 @@ class _15_BuildDB(unittest.TestCase):
 		err, code = run(command)
 		self.assertTrue(code==0, msg=err)
 
+class _16_MergeFewSites(unittest.TestCase):
+	""" more threads than sites """
+	def test_class(self):
+		write_snps_samples('regression')
+		for threads in [1, 8]:
+			command = 'merge_midas.py snps regression/snps_%s -i regression/samples -t dir -d regression/db --all_samples --all_sites --threads %s' % (threads, threads)
+			err, code = run(command)
+			self.assertTrue(code==0, msg=err)
+		for file in ['snps_info.txt', 'snps_freq.txt', 'snps_depth.txt']:
+			self.assertEqual(open('regression/snps_1/sp1/%s' % file).read(), open('regression/snps_8/sp1/%s' % file).read())
+		self.assertEqual(len(open('regression/snps_8/sp1/snps_info.txt').readlines()), 4)
+
+class _17_MergeNoPassingSites(unittest.TestCase):
+	""" no site passes filters """
+	def test_class(self):
+		command = 'merge_midas.py snps regression/snps_none -i regression/samples -t dir -d regression/db --all_samples --snp_type quad --threads 2'
+		err, code = run(command)
+		self.assertTrue(code==0, msg=err)
+		self.assertEqual(len(open('regression/snps_none/sp1/snps_info.txt').readlines()), 1)
+		self.assertTrue(os.path.exists('regression/snps_none/sp1/snps_index.npz'))
+
+class _18_PooledConsensusDiversity(unittest.TestCase):
+	""" pooled diversity of consensus alleles: only site 2 varies, with a pooled frequency of 0.5 """
+	def test_class(self):
+		command = 'snp_diversity.py regression/snps_8/sp1 --out regression/pooled.txt --consensus --sample_type pooled-samples'
+		err, code = run(command)
+		self.assertTrue(code==0, msg=err)
+		result = dict(zip(*[line.rstrip('\n').split('\t') for line in open('regression/pooled.txt')]))
+		self.assertEqual(int(result['sites']), 3)
+		self.assertAlmostEqual(float(result['pi']), 0.5)
+
+class _19_StreamSeqs(unittest.TestCase):
+	""" CRLF fastq whose records span more than 4 lines only after the first block of input """
+	def test_class(self):
+		if not os.path.exists('regression'): os.makedirs('regression')
+		with open('regression/reads.fq', 'wb') as f:
+			f.write((b'@r\r\n' + b'A'*100 + b'\r\n+\r\n' + b'I'*100 + b'\r\n') * 25000) # more than one block
+			f.write(b'@m\r\n' + b'C'*50 + b'\r\n' + b'C'*50 + b'\r\n+\r\n' + b'I'*50 + b'\r\n' + b'I'*50 + b'\r\n')
+		command = '%s -m midas.run.stream_seqs -1 regression/reads.fq > regression/reads.fa' % sys.executable
+		err, code = run(command)
+		self.assertTrue(code==0, msg=err)
+		self.assertEqual(err.decode(), '25001\t2500100')
+		self.assertEqual(open('regression/reads.fa').read().split('\n')[-3:], ['>m_100', 'C'*100, ''])
+
 if __name__ == '__main__':
 	try:
 		dir_name = os.path.dirname(os.path.abspath(__file__))
 		os.chdir(dir_name)
 		unittest.main(exit=False)
-		for dir in ['sample', 'species', 'genes', 'snps', 'genomes', 'db']:
+		for dir in ['sample', 'species', 'genes', 'snps', 'genomes', 'db', 'regression']:
 			shutil.rmtree(dir)
 	except:
 		print("")
-		for dir in ['sample', 'species', 'genes', 'snps', 'genomes', 'db']:
+		for dir in ['sample', 'species', 'genes', 'snps', 'genomes', 'db', 'regression']:
 			if os.path.exists(dir): shutil.rmtree(dir)